@@ -0,0 +1,264 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys, time, asyncio, logging
+import logging.config
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+from .hserv import HServHandler, HServResponse
+from .hserv_admission import HServAdmission
+#========================================
+class _AdmittedAsyncBody:
+    def __init__(self, admission, adm_class, body):
+        self.mAdmission = admission
+        self.mClass = adm_class
+        self.mBody = body
+
+    def __aiter__(self):
+        return self.mBody.__aiter__()
+
+    async def aclose(self):
+        try:
+            if hasattr(self.mBody, "aclose"):
+                await self.mBody.aclose()
+        finally:
+            if self.mClass is not None:
+                self.mAdmission.leave(self.mClass)
+                self.mClass = None
+
+#========================================
+class AsyncHServHandler(HServHandler):
+    def __init__(self, application, config, in_container):
+        HServHandler.__init__(self, application, config, in_container)
+        self.mExecutor = ThreadPoolExecutor(
+            config.get("async-threads", 16), thread_name_prefix = "hserv")
+        self.mAsyncMode = (hasattr(application, "requestAsync")
+            or self.mRouter.hasAsyncRoutes())
+
+    @staticmethod
+    def _makeEnviron(scope, body, body_size):
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", ""),
+            "PATH_INFO": scope["path"],
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "CONTENT_LENGTH": str(body_size)}
+        server = scope.get("server")
+        if server:
+            environ["SERVER_NAME"], environ["SERVER_PORT"] = (
+                server[0], str(server[1]))
+        client = scope.get("client")
+        if client:
+            environ["REMOTE_ADDR"] = client[0]
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace('-', '_')
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+            elif name != "CONTENT_LENGTH":
+                key = "HTTP_" + name
+                environ[key] = (environ[key] + "," + value
+                    if key in environ else value)
+        return environ
+
+    async def _readBody(self, receive):
+        # Large body goes to temporary file, as in hserv.py
+        body = SpooledTemporaryFile(max_size = self.mSpoolMemSize)
+        body_size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None, 0
+            chunk = message.get("body", b"")
+            body.write(chunk)
+            body_size += len(chunk)
+            if not message.get("more_body"):
+                body.seek(0)
+                return body, body_size
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.mExecutor.shutdown(wait = False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        assert scope["type"] == "http"
+        body, body_size = await self._readBody(receive)
+        if body is None:
+            return
+        try:
+            await self._processCall(
+                self._makeEnviron(scope, body, body_size), send)
+        finally:
+            body.close()
+
+    async def _processCall(self, environ, send):
+        response = dict()
+
+        def start_response(status, headers, exc_info = None):
+            response["status"] = int(status.split()[0])
+            response["headers"] = [(name.lower().encode("latin-1"),
+                value.encode("latin-1")) for name, value in headers]
+
+        loop = asyncio.get_running_loop()
+        if self.mAsyncMode:
+            ret = await self._trackAsync(environ, start_response)
+        else:
+            ret = await loop.run_in_executor(self.mExecutor,
+                self.processRq, environ, start_response)
+        if "status" not in response:
+            logging.error("No response status on request: "
+                + environ["PATH_INFO"])
+            if hasattr(ret, "aclose"):
+                await ret.aclose()
+            elif hasattr(ret, "close"):
+                ret.close()
+            response["status"] = 500
+            response["headers"] = [(b"content-type", b"text/plain")]
+            ret = [b"Internal Server Error"]
+        await send({"type": "http.response.start",
+            "status": response["status"], "headers": response["headers"]})
+        try:
+            if hasattr(ret, "__aiter__"):
+                async for chunk in ret:
+                    await send({"type": "http.response.body",
+                        "body": chunk, "more_body": True})
+            elif isinstance(ret, list):
+                for chunk in ret:
+                    await send({"type": "http.response.body",
+                        "body": chunk, "more_body": True})
+            else:
+                ret_iter = iter(ret)
+                while True:
+                    chunk = await loop.run_in_executor(
+                        self.mExecutor, next, ret_iter, None)
+                    if chunk is None:
+                        break
+                    await send({"type": "http.response.body",
+                        "body": chunk, "more_body": True})
+        finally:
+            if hasattr(ret, "aclose"):
+                await ret.aclose()
+            elif hasattr(ret, "close"):
+                ret.close()
+        await send({"type": "http.response.body", "body": b""})
+
+    #===============================================
+    async def _admitRqAsync(self, environ, start_response):
+        if self.mAdmission is None:
+            return await self.processRqAsync(environ, start_response)
+        adm_class = self.getAdmissionClass(environ)
+        # Event loop can not block on admission queue, so the request is
+        # either admitted at once or shed
+        if not self.mAdmission.enter(adm_class, wait = False):
+            return self._makeOverloadResponse(environ, start_response)
+        try:
+            ret = await self.processRqAsync(environ, start_response)
+        except BaseException:
+            self.mAdmission.leave(adm_class)
+            raise
+        if hasattr(ret, "__aiter__"):
+            if environ.get(HServAdmission.sFreeBodyKey) is ret:
+                self.mAdmission.leave(adm_class)
+                return ret
+            return _AdmittedAsyncBody(self.mAdmission, adm_class, ret)
+        return self.mAdmission.wrapBody(adm_class, ret, environ)
+
+    async def _trackAsync(self, environ, start_response):
+        if self.mMetrics is None:
+            return await self._admitRqAsync(environ, start_response)
+        path_key = self.getPathKey(environ)
+        if path_key == self.mMetrics.getPath():
+            return self.processRq(environ, start_response)
+        response = dict()
+
+        def _start_response(status, headers, exc_info = None):
+            response["status"], response["headers"] = status, headers
+            return start_response(status, headers, exc_info)
+
+        # Requests are not profiled: profiler of event loop thread
+        # would mix all concurrent requests
+        tm0 = time.perf_counter()
+        ret = await self._admitRqAsync(environ, _start_response)
+        return self.mMetrics.trackBody(environ, path_key, response, tm0, ret)
+
+    async def processRqAsync(self, environ, start_response):
+        resp_h = HServResponse(start_response, environ,
+            self.mCompressor, self.mEncoders)
+        rq_descr = []
+        loop = asyncio.get_running_loop()
+        try:
+            if environ["REQUEST_METHOD"] in ("POST", "PUT"):
+                # Parsing of body (multipart, spooling) blocks
+                rq_path, query_args = await loop.run_in_executor(
+                    self.mExecutor, self.parseRequest, environ)
+            else:
+                rq_path, query_args = self.parseRequest(environ)
+            file_path, cache_control = self._findFilePath(rq_path)
+            if file_path is not None:
+                ret = await loop.run_in_executor(self.mExecutor,
+                    self.fileResponse, resp_h, file_path, query_args,
+                    True, cache_control)
+                if ret is not False:
+                    return ret
+            route = self._findRoute(rq_path, query_args)
+            if route is not None:
+                if not route.acceptsMethod(environ["REQUEST_METHOD"]):
+                    return resp_h.makeResponse(error = 405)
+                if route.isAsync():
+                    return await route.requestAsync(
+                        resp_h, rq_path, query_args, rq_descr)
+                return await loop.run_in_executor(self.mExecutor,
+                    self.requestHandler, resp_h, environ, route,
+                    rq_path, query_args, rq_descr)
+            if not hasattr(self.mApplication, "requestAsync"):
+                return await loop.run_in_executor(self.mExecutor,
+                    self.requestHandler, resp_h, environ, None,
+                    rq_path, query_args, rq_descr)
+            return await self.mApplication.requestAsync(
+                resp_h, rq_path, query_args, rq_descr)
+        except AssertionError as exc:
+            return self._makeResponceException(rq_descr, resp_h,
+                exc.args[0] if len(exc.args) > 0 else None)
+        except Exception:
+            return self._makeResponceException(rq_descr, resp_h)
+
+#========================================
+def setupAsyncHServer(application, config, in_container):
+    logging_config = config.get("logging")
+    if logging_config:
+        logging.config.dictConfig(logging_config)
+        logging.basicConfig(level = 0)
+    AsyncHServHandler.init(application, config, in_container)
+    return AsyncHServHandler.sInstance
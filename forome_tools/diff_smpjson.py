@@ -20,6 +20,8 @@
 import sys, json
 from collections import defaultdict
 
+from . import json_codec
+
 MARK_LEFT = "<--<--"
 MARK_RIGHT = "-->-->"
 #=====================================
@@ -163,12 +165,12 @@ if __name__ == "__main__":
             for line in inp:
                 if line.startswith("==="):
                     if len(cur_block) > 0:
-                        samples.append(json.loads('\n'.join(cur_block)))
+                        samples.append(json_codec.loads('\n'.join(cur_block)))
                         cur_block = []
                 else:
                     cur_block.append(line.rstrip())
             if len(cur_block) > 0:
-                samples.append(json.loads('\n'.join(cur_block)))
+                samples.append(json_codec.loads('\n'.join(cur_block)))
         samples_seq.append(samples)
     assert len(samples_seq[0]) == len(samples_seq[1]), (
         "Difference in sample counts: %d/%d"
@@ -0,0 +1,391 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os, io, json, zlib
+from bisect import bisect_right
+
+from .log_err import logException
+#===============================================
+# Access points of gzip file allow to start decompression in the middle.
+# Standard zlib can not start inflate at arbitrary bit position, so points
+# are byte-aligned: starts of gzip members (bgzip, concatenated files)
+# and ends of empty stored blocks made by sync/full flush (pigz); the
+# latter need 32K window of preceding data as dictionary
+#===============================================
+class GzipAccessPoint:
+    def __init__(self, comp_offset, uncomp_offset, line_no, mid_line,
+            window = None):
+        self.mCompOffset = comp_offset
+        self.mUncompOffset = uncomp_offset
+        # The first line that starts at the point or after it
+        self.mLineNo = line_no
+        self.mMidLine = mid_line
+        self.mWindow = window
+
+    def getCompOffset(self):
+        return self.mCompOffset
+
+    def getUncompOffset(self):
+        return self.mUncompOffset
+
+    def getLineNo(self):
+        return self.mLineNo
+
+    def isMidLine(self):
+        return self.mMidLine
+
+    def getWindow(self):
+        return self.mWindow
+
+#===============================================
+class _IndexBuilder:
+    sMarker = b"\x00\x00\xff\xff"
+    sWindowSize = 1 << 15
+    sVerifySize = 1 << 16
+
+    def __init__(self, span):
+        self.mSpan = span
+        self.mPoints = [GzipAccessPoint(0, 0, 0, False)]
+        self.mOutSize = 0
+        self.mNewLines = 0
+        self.mWindow = b""
+        self.mCandidate = None
+
+    def getPoints(self):
+        return self.mPoints
+
+    def getUncompSize(self):
+        return self.mOutSize
+
+    def getLineCount(self):
+        if self.mOutSize > 0 and not self.mWindow.endswith(b'\n'):
+            return self.mNewLines + 1
+        return self.mNewLines
+
+    def _wantPoint(self):
+        return (self.mCandidate is None and self.mOutSize
+            - self.mPoints[-1].getUncompOffset() >= self.mSpan)
+
+    def findMarker(self, data):
+        if not self._wantPoint():
+            return -1
+        pos = data.find(self.sMarker)
+        return pos + len(self.sMarker) if pos >= 0 else -1
+
+    def _makePoint(self, comp_offset, window):
+        mid_line = self.mOutSize > 0 and not self.mWindow.endswith(b'\n')
+        return GzipAccessPoint(comp_offset, self.mOutSize,
+            self.mNewLines + (1 if mid_line else 0), mid_line, window)
+
+    def addData(self, data, out):
+        self.mOutSize += len(out)
+        self.mNewLines += out.count(b'\n')
+        self.mWindow = (self.mWindow + out)[-self.sWindowSize:]
+        if self.mCandidate is not None:
+            _, comp_seq, out_seq, out_size = self.mCandidate
+            comp_seq.append(data)
+            out_seq.append(out)
+            self.mCandidate[3] = out_size + len(out)
+            if self.mCandidate[3] >= self.sVerifySize:
+                self._verify()
+
+    def markerPoint(self, comp_offset):
+        # Marker can occur in compressed data by chance, so the point is
+        # verified by trial decompression
+        if self._wantPoint():
+            self.mCandidate = [self._makePoint(comp_offset, self.mWindow),
+                [], [], 0]
+
+    def memberPoint(self, comp_offset):
+        if self.mCandidate is not None:
+            self._verify()
+        if self._wantPoint():
+            self.mPoints.append(self._makePoint(comp_offset, None))
+
+    def _verify(self):
+        point, comp_seq, out_seq, _ = self.mCandidate
+        self.mCandidate = None
+        try:
+            decomp = zlib.decompressobj(-15, zdict = point.getWindow())
+            trial = decomp.decompress(b"".join(comp_seq))
+        except zlib.error:
+            return
+        if len(trial) > 0 and b"".join(out_seq).startswith(trial):
+            self.mPoints.append(point)
+
+    def finish(self):
+        if self.mCandidate is not None:
+            self._verify()
+        # Start of absent member after the last one
+        while self.mPoints[-1].getUncompOffset() >= self.mOutSize > 0:
+            self.mPoints.pop()
+
+#===============================================
+class _InflateStream(io.RawIOBase):
+    sBlockSize = 1 << 18
+    # Builder gets data in small pieces to find points inside blocks
+    sFeedSize = 1 << 14
+
+    def __init__(self, fname, point, builder = None):
+        io.RawIOBase.__init__(self)
+        self.mInput = open(fname, "rb")
+        self.mInput.seek(point.getCompOffset())
+        self.mFeedOffset = point.getCompOffset()
+        self.mRawMode = point.getWindow() is not None
+        self.mDecomp = (zlib.decompressobj(-15, zdict = point.getWindow())
+            if self.mRawMode else zlib.decompressobj(31))
+        self.mFed = False
+        self.mPending = b""
+        self.mBuilder = builder
+        self.mBuf = b""
+        self.mBufPos = 0
+        self.mEOF = False
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.mInput.close()
+        io.RawIOBase.close(self)
+
+    def _read(self):
+        data = self.mPending or self.mInput.read(self.sBlockSize
+            if self.mBuilder is None else self.sFeedSize)
+        self.mPending = b""
+        return data
+
+    def _inflateMore(self):
+        data = self._read()
+        if not self.mFed and not self.mRawMode:
+            # Zero padding after gzip member is allowed
+            data = data.lstrip(b'\x00')
+            while not data:
+                self.mFeedOffset = self.mInput.tell()
+                data = self.mInput.read(self.sBlockSize)
+                if not data:
+                    break
+                data = data.lstrip(b'\x00')
+            self.mFeedOffset = self.mInput.tell() - len(data)
+        if not data:
+            if self.mFed:
+                raise EOFError("Compressed file ended before "
+                    "the end-of-stream marker was reached")
+            self.mEOF = True
+            if self.mBuilder is not None:
+                self.mBuilder.finish()
+            return
+        marker_pos = -1
+        if self.mBuilder is not None:
+            marker_pos = self.mBuilder.findMarker(data)
+            if 0 < marker_pos < len(data):
+                self.mPending = data[marker_pos:]
+                data = data[:marker_pos]
+        out = self.mDecomp.decompress(data)
+        self.mFed = True
+        self.mFeedOffset += len(data)
+        if self.mDecomp.eof:
+            rest = self.mDecomp.unused_data
+            data = data[:len(data) - len(rest)]
+            member_end = self.mFeedOffset - len(rest)
+            if self.mRawMode:
+                # Trailer of member: CRC32 and size
+                while len(rest) < 8:
+                    more = self._read()
+                    if not more:
+                        break
+                    rest += more
+                rest = rest[8:]
+                member_end += 8
+            self.mPending = rest + self.mPending
+            self.mFeedOffset = member_end
+            self.mDecomp = zlib.decompressobj(31)
+            self.mRawMode = False
+            self.mFed = False
+            if self.mBuilder is not None:
+                self.mBuilder.addData(data, out)
+                self.mBuilder.memberPoint(member_end)
+        elif self.mBuilder is not None:
+            self.mBuilder.addData(data, out)
+            if marker_pos == len(data):
+                self.mBuilder.markerPoint(self.mFeedOffset)
+        self.mBuf, self.mBufPos = out, 0
+
+    def readinto(self, buf):
+        while self.mBufPos >= len(self.mBuf):
+            if self.mEOF:
+                return 0
+            self._inflateMore()
+        cnt = min(len(buf), len(self.mBuf) - self.mBufPos)
+        buf[:cnt] = self.mBuf[self.mBufPos:self.mBufPos + cnt]
+        self.mBufPos += cnt
+        return cnt
+
+    def skipLines(self, count):
+        while count > 0:
+            while self.mBufPos >= len(self.mBuf):
+                if self.mEOF:
+                    return
+                self._inflateMore()
+            cnt = self.mBuf.count(b'\n', self.mBufPos)
+            if cnt < count:
+                count -= cnt
+                self.mBufPos = len(self.mBuf)
+                continue
+            pos = self.mBufPos
+            for _ in range(count):
+                pos = self.mBuf.index(b'\n', pos) + 1
+            self.mBufPos = pos
+            count = 0
+
+#===============================================
+class GzipIndex:
+    sSuffix = ".gzidx"
+    sMagic = b"GZIDX1\n"
+    sDefaultSpan = 1 << 24
+
+    def __init__(self, fname, points, line_count, uncomp_size):
+        self.mFName = fname
+        self.mPoints = points
+        self.mLineCount = line_count
+        self.mUncompSize = uncomp_size
+        self.mLineNumbers = [point.getLineNo() for point in points]
+
+    def getFName(self):
+        return self.mFName
+
+    def getPoints(self):
+        return self.mPoints
+
+    def getLineCount(self):
+        return self.mLineCount
+
+    def getUncompSize(self):
+        return self.mUncompSize
+
+    @classmethod
+    def _fileKey(cls, fname):
+        file_stat = os.stat(fname)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    @classmethod
+    def load(cls, fname):
+        # None if index is absent or the file is changed after indexing
+        try:
+            with open(fname + cls.sSuffix, "rb") as inp:
+                if inp.readline() != cls.sMagic:
+                    return None
+                header = json.loads(inp.readline())
+                if header["file"] != cls._fileKey(fname):
+                    return None
+                points = []
+                for comp_offset, uncomp_offset, line_no, mid_line, \
+                        window_size in header["points"]:
+                    window = (zlib.decompress(inp.read(window_size))
+                        if window_size > 0 else None)
+                    points.append(GzipAccessPoint(comp_offset,
+                        uncomp_offset, line_no, mid_line, window))
+        except (OSError, ValueError, KeyError, zlib.error):
+            return None
+        return cls(fname, points, header["lines"], header["size"])
+
+    def save(self):
+        windows = [zlib.compress(point.getWindow())
+            if point.getWindow() is not None else b""
+            for point in self.mPoints]
+        header = {
+            "file": self._fileKey(self.mFName),
+            "lines": self.mLineCount,
+            "size": self.mUncompSize,
+            "points": [[point.getCompOffset(), point.getUncompOffset(),
+                point.getLineNo(), point.isMidLine(), len(window)]
+                for point, window in zip(self.mPoints, windows)]}
+        tmp_name = self.mFName + self.sSuffix + ".tmp"
+        with open(tmp_name, "wb") as outp:
+            outp.write(self.sMagic)
+            outp.write(json.dumps(header).encode("utf-8") + b'\n')
+            for window in windows:
+                outp.write(window)
+        os.replace(tmp_name, self.mFName + self.sSuffix)
+
+    @classmethod
+    def makeBuilderStream(cls, fname, span = None):
+        # Stream of decompressed data that builds and saves index
+        # when it is read up to the end
+        builder = _IndexBuilder(span or cls.sDefaultSpan)
+        file_key = cls._fileKey(fname)
+        start_point = builder.getPoints()[0]
+
+        class _BuilderStream(_InflateStream):
+            mIndex = None
+
+            def _inflateMore(self):
+                _InflateStream._inflateMore(self)
+                if (self.mEOF and self.mIndex is None
+                        and cls._fileKey(fname) == file_key):
+                    self.mIndex = cls(fname, builder.getPoints(),
+                        builder.getLineCount(), builder.getUncompSize())
+                    try:
+                        self.mIndex.save()
+                    except OSError:
+                        # Reading goes on, index is just not kept
+                        logException("Gzip index is not saved: " + fname,
+                            error_mode = False)
+        return _BuilderStream(fname, start_point, builder)
+
+    @classmethod
+    def build(cls, fname, span = None):
+        stream = cls.makeBuilderStream(fname, span)
+        with stream:
+            while stream.read(1 << 20):
+                pass
+        return stream.mIndex
+
+    @classmethod
+    def loadOrBuild(cls, fname, span = None):
+        index = cls.load(fname)
+        if index is None:
+            index = cls.build(fname, span)
+        return index
+
+    def findPoint(self, line_no):
+        return self.mPoints[max(0,
+            bisect_right(self.mLineNumbers, line_no) - 1)]
+
+    def openStream(self, start_line = 0):
+        # Binary stream of lines from start_line
+        point = self.findPoint(start_line)
+        stream = _InflateStream(self.mFName, point)
+        stream.skipLines(start_line - point.getLineNo()
+            + (1 if point.isMidLine() else 0))
+        return stream
+
+    def splitRanges(self, count):
+        # Line ranges [start, end) of near equal data size,
+        # bounds are set at access points
+        bounds = [0]
+        for idx in range(1, count):
+            target = self.mUncompSize * idx // count
+            point = min(self.mPoints,
+                key = lambda pnt: abs(pnt.getUncompOffset() - target))
+            if bounds[-1] < point.getLineNo() < self.mLineCount:
+                bounds.append(point.getLineNo())
+        bounds.append(self.mLineCount)
+        return list(zip(bounds[:-1], bounds[1:]))
@@ -18,12 +18,22 @@
 #  limitations under the License.
 #
 
-import os, logging, json
+import os, stat, logging, threading, gzip, zlib, struct
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from email.utils import formatdate, parsedate_to_datetime
 import logging.config
 from urllib.parse import parse_qs
 from multipart import parse_form_data
 
+from . import json_codec
 from .log_err import logException
+from .hserv_metrics import HServMetrics
+from .hserv_router import HServRouter
+from .hserv_encoders import HServEncoders
+from .hserv_admission import HServAdmission
+from .hserv_cache import HServResponseCache
 #========================================
 class HServResponse:
     #========================================
@@ -32,6 +42,8 @@ class HServResponse:
         "html":   "text/html",
         "js":     "application/javascript",
         "json":   "application/json",
+        "ndjson": "application/x-ndjson",
+        "sse":    "text/event-stream",
         "bson":   "application/bson",
         "png":    "image/png",
         "txt":    "text/plain",
@@ -73,17 +85,235 @@ class HServResponse:
     sErrorCodes = {
         202: "202 Accepted",
         204: "204 No Content",
+        206: "206 Partial Content",
         303: "303 See Other",
+        304: "304 Not Modified",
         400: "400 Bad Request",
         403: "403 Forbidden",
         408: "408 Request Timeout",
+        413: "413 Payload Too Large",
         404: "404 Not Found",
+        405: "405 Method Not Allowed",
         422: "422 Unprocessable Entity",
+        416: "416 Range Not Satisfiable",
         423: "423 Locked",
-        500: "500 Internal Error"}
+        500: "500 Internal Error",
+        503: "503 Service Unavailable"}
 
-    def __init__(self, start_response):
+    sFileBlockSize = 1 << 16
+
+    def __init__(self, start_response, environ = None, compressor = None,
+            encoders = None):
         self.mStartResponse = start_response
+        self.mEnviron = environ if environ is not None else dict()
+        self.mCompressor = compressor
+        self.mEncoders = encoders
+        self.mCacheTags = []
+
+    def addCacheTag(self, tag):
+        self.mCacheTags.append(tag)
+
+    def getCacheTags(self):
+        return self.mCacheTags
+
+    def getEncoding(self, mode, size):
+        if self.mCompressor is None:
+            return None
+        return self.mCompressor.selectEncoding(
+            self.mEnviron.get("HTTP_ACCEPT_ENCODING"), mode, size)
+
+    @staticmethod
+    def _parseRange(range_spec, file_size):
+        unit, _, ranges = range_spec.partition('=')
+        if unit.strip() != "bytes" or ',' in ranges:
+            return None
+        first, _, last = ranges.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        # Invalid range is ignored, as well as range of empty file
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            if not last:
+                return None
+            length = int(last)
+            if length == 0:
+                return False
+            if file_size == 0:
+                return None
+            return max(0, file_size - length), file_size - 1
+        first = int(first)
+        if (last and int(last) < first) or file_size == 0:
+            return None
+        if first >= file_size:
+            return False
+        return first, min(int(last), file_size - 1) if last else file_size - 1
+
+    @classmethod
+    def _iterFile(cls, inp, length):
+        try:
+            while length > 0:
+                block = inp.read(min(cls.sFileBlockSize, length))
+                if not block:
+                    break
+                length -= len(block)
+                yield block
+        finally:
+            inp.close()
+
+    @staticmethod
+    def _fileValidators(file_stat, encoding = None):
+        etag = '"%x-%x"' % (file_stat.st_mtime_ns, file_stat.st_size)
+        if encoding is not None:
+            etag = etag[:-1] + "-" + encoding + '"'
+        return etag, formatdate(file_stat.st_mtime, usegmt = True)
+
+    def isFileNotModified(self, file_stat, encoding = None):
+        return self._notModified(
+            self._fileValidators(file_stat, encoding)[0], file_stat)
+
+    def _notModified(self, etag, file_stat):
+        if_none_match = self.mEnviron.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return "*" in tags or etag in tags or ("W/" + etag) in tags
+        if_modified_since = self.mEnviron.get("HTTP_IF_MODIFIED_SINCE")
+        if if_modified_since is not None:
+            try:
+                since_dt = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            return int(file_stat.st_mtime) <= since_dt.timestamp()
+        return False
+
+    def makeFileResponse(self, fpath, file_stat, mode, add_headers = None,
+            cache_control = None, content = None, encoding = None):
+        etag, last_modified = self._fileValidators(file_stat, encoding)
+        response_headers = [("ETag", etag),
+            ("Last-Modified", last_modified)]
+        if cache_control is not None:
+            response_headers.append(("Cache-Control", cache_control))
+        if self.mCompressor is not None and mode in self.mCompressor:
+            response_headers.append(("Vary", "Accept-Encoding"))
+        if self._notModified(etag, file_stat):
+            self.mStartResponse(self.sErrorCodes[304], response_headers)
+            return []
+        file_size = (file_stat.st_size if encoding is None
+            else len(content))
+        response_headers.append(("Content-Type", self.sContentTypes[mode]))
+        if encoding is not None:
+            response_headers.append(("Content-Encoding", encoding))
+        else:
+            response_headers.append(("Accept-Ranges", "bytes"))
+        if add_headers is not None:
+            response_headers += add_headers
+        byte_range = None
+        if (encoding is None and "HTTP_RANGE" in self.mEnviron
+                and self.mEnviron.get(
+                "HTTP_IF_RANGE", etag) in (etag, last_modified)):
+            byte_range = self._parseRange(
+                self.mEnviron["HTTP_RANGE"], file_size)
+        if byte_range is False:
+            self.mStartResponse(self.sErrorCodes[416], response_headers
+                + [("Content-Range", "bytes */%d" % file_size)])
+            return []
+        if byte_range is None:
+            response_headers.append(("Content-Length", str(file_size)))
+            self.mStartResponse("200 OK", response_headers)
+            if content is not None:
+                return [content]
+            inp = open(fpath, "rb")
+            file_wrapper = self.mEnviron.get("wsgi.file_wrapper")
+            if file_wrapper is not None:
+                return self._freeBody(file_wrapper(inp, self.sFileBlockSize))
+            return self._freeBody(self._iterFile(inp, file_size))
+        first, last = byte_range
+        response_headers += [
+            ("Content-Range", "bytes %d-%d/%d" % (first, last, file_size)),
+            ("Content-Length", str(last - first + 1))]
+        self.mStartResponse(self.sErrorCodes[206], response_headers)
+        if content is not None:
+            return [content[first:last + 1]]
+        inp = open(fpath, "rb")
+        inp.seek(first)
+        return self._freeBody(self._iterFile(inp, last - first + 1))
+
+    def _freeBody(self, body):
+        # Admission control does not hold slot for sending of body
+        # and keeps it as is: server can use sendfile for files,
+        # and long event streams do not block other requests
+        self.mEnviron[HServAdmission.sFreeBodyKey] = body
+        return body
+
+    @staticmethod
+    def _iterJSonChunks(records, mode, chunk_size, raw_chunks):
+        # Raw chunks are ready pieces of output, passed without framing
+        if mode == "json" and not raw_chunks:
+            head, separator, tail = b"[", b",", b"]"
+        else:
+            head, separator, tail = b"", b"", b""
+        buf, buf_size = [head], len(head)
+        for idx, rec in enumerate(records):
+            if raw_chunks:
+                rep = rec.encode("utf-8") if isinstance(rec, str) else rec
+            else:
+                rep = json_codec.dumpsBytes(rec)
+                if mode == "ndjson":
+                    rep += b"\n"
+                elif idx > 0:
+                    rep = separator + rep
+            buf.append(rep)
+            buf_size += len(rep)
+            if buf_size >= chunk_size:
+                yield b"".join(buf)
+                buf, buf_size = [], 0
+        buf.append(tail)
+        chunk = b"".join(buf)
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    async def _aiterRawChunks(records):
+        async for rec in records:
+            yield rec.encode("utf-8") if isinstance(rec, str) else rec
+
+    def makeStreamResponse(self, records, mode = "json",
+            chunk_size = 1 << 16, raw_chunks = False, add_headers = None,
+            hold_slot = True):
+        response_headers = [("Content-Type", self.sContentTypes[mode])]
+        if hasattr(records, "__aiter__"):
+            # Async stream (ahserv.py): ready chunks are sent one by one
+            assert raw_chunks, "Async stream requires raw chunks"
+            chunks = self._aiterRawChunks(records)
+            encoding = None
+        else:
+            chunks = self._iterJSonChunks(records, mode,
+                chunk_size, raw_chunks)
+            encoding = self.getEncoding(mode, None)
+        if encoding is not None:
+            chunks = self.mCompressor.compressStream(chunks, encoding)
+            response_headers += [("Content-Encoding", encoding),
+                ("Vary", "Accept-Encoding")]
+        if add_headers is not None:
+            response_headers += add_headers
+        self.mStartResponse("200 OK", response_headers)
+        if not hold_slot:
+            return self._freeBody(chunks)
+        return chunks
+
+    def makeObjResponse(self, obj, error = None, add_headers = None):
+        # Encoding is negotiated by Accept header: JSON or BSON
+        if self.mEncoders is None:
+            mode = "json"
+            content = json_codec.dumpsBytes(obj)
+        else:
+            mode = self.mEncoders.selectMode(self.mEnviron.get("HTTP_ACCEPT"))
+            content = self.mEncoders.encode(obj, mode, self.mEnviron)
+        response_headers = [("Vary", "Accept")]
+        if add_headers is not None:
+            response_headers += add_headers
+        return self.makeResponse(mode = mode, content = content,
+            error = error, add_headers = response_headers,
+            without_decoding = True)
 
     def makeResponse(self, mode = "html", content = None, error = None,
             add_headers = None, without_decoding = False):
@@ -95,8 +325,15 @@ class HServResponse:
                 response_body = bytes(content)
             else:
                 response_body = content.encode("utf-8")
-            response_headers = [("Content-Type", self.sContentTypes[mode]),
-                                ("Content-Length", str(len(response_body)))]
+            response_headers = [("Content-Type", self.sContentTypes[mode])]
+            encoding = self.getEncoding(mode, len(response_body))
+            if encoding is not None:
+                response_body = self.mCompressor.compress(
+                    response_body, encoding)
+                response_headers += [("Content-Encoding", encoding),
+                    ("Vary", "Accept-Encoding")]
+            response_headers.append(
+                ("Content-Length", str(len(response_body))))
         else:
             response_body = response_status.encode("utf-8")
             response_headers = []
@@ -105,6 +342,143 @@ class HServResponse:
         self.mStartResponse(response_status, response_headers)
         return [response_body]
 
+#========================================
+class HServCompressor:
+    sSkipModes = {"png", "gif", "jpg", "ico", "mp3", "mpg", "wav",
+        "gz", "tgz", "zip", "rar", "jar", "epub", "bson", "sse",
+        "xlsx", "docx", "pptx", "odp", "ods", "odt"}
+
+    def __init__(self, config):
+        self.mMinSize = config.get("min-size", 1024)
+        self.mLevel = config.get("level", 6)
+        self.mBlockSize = config.get("block-size", 1 << 18)
+        self.mParallelMinSize = config.get("parallel-min-size", 1 << 21)
+        threads = config.get("threads", 0)
+        self.mExecutor = (ThreadPoolExecutor(threads,
+            thread_name_prefix = "compress") if threads > 0 else None)
+
+    def __contains__(self, mode):
+        return mode not in self.sSkipModes
+
+    def selectEncoding(self, accept_encoding, mode, size):
+        if (not accept_encoding or mode not in self
+                or (size is not None and size < self.mMinSize)):
+            return None
+        accepted = dict()
+        for item in accept_encoding.split(','):
+            name, _, params = item.strip().partition(';')
+            quality = 1.
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.
+            accepted[name.strip().lower()] = quality
+        for encoding in ("gzip", "deflate"):
+            if accepted.get(encoding, accepted.get("*", 0.)) > 0:
+                return encoding
+        return None
+
+    def compress(self, body, encoding):
+        if (self.mExecutor is not None
+                and len(body) >= self.mParallelMinSize):
+            raw_data = self._parallelDeflate(body)
+            if encoding == "gzip":
+                return (b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+                    + raw_data + struct.pack("<LL",
+                    zlib.crc32(body), len(body) & 0xFFFFFFFF))
+            return (b"\x78\x9c" + raw_data
+                + struct.pack(">L", zlib.adler32(body)))
+        if encoding == "gzip":
+            return gzip.compress(body, self.mLevel, mtime = 0)
+        return zlib.compress(body, self.mLevel)
+
+    def compressStream(self, chunks, encoding):
+        comp = zlib.compressobj(self.mLevel, zlib.DEFLATED,
+            31 if encoding == "gzip" else 15)
+        for chunk in chunks:
+            data = comp.compress(chunk) + comp.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield comp.flush(zlib.Z_FINISH)
+
+    def _deflateBlock(self, block, is_last):
+        comp = zlib.compressobj(self.mLevel, zlib.DEFLATED, -15)
+        return comp.compress(block) + comp.flush(
+            zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+    def _parallelDeflate(self, body):
+        # Blocks are compressed independently and joined by sync flush
+        # points, as pigz does, so the result is one valid deflate stream
+        starts = range(0, len(body), self.mBlockSize)
+        view = memoryview(body)
+        futures = [self.mExecutor.submit(self._deflateBlock,
+            view[pos:pos + self.mBlockSize],
+            pos + self.mBlockSize >= len(body)) for pos in starts]
+        return b"".join(future.result() for future in futures)
+
+#========================================
+class StaticFileCache:
+    def __init__(self, max_size, max_file_size):
+        self.mMaxSize = max_size
+        self.mMaxFileSize = max_file_size
+        self.mEntries = OrderedDict()
+        self.mSize = 0
+        self.mLock = threading.Lock()
+
+    def getContent(self, fpath, file_stat,
+            encoding = None, compressor = None):
+        content = self._getContent(fpath, file_stat)
+        if content is None or encoding is None:
+            return content
+        with self.mLock:
+            entry = self.mEntries.get(fpath)
+            if entry is None or entry[1] is not content:
+                return None
+            variant = entry[2].get(encoding)
+        if variant is None:
+            variant = compressor.compress(content, encoding)
+            with self.mLock:
+                entry = self.mEntries.get(fpath)
+                if entry is not None and entry[1] is content:
+                    entry[2][encoding] = variant
+                    self.mSize += len(variant)
+                    self._shrink()
+        return variant
+
+    def _getContent(self, fpath, file_stat):
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self.mLock:
+            entry = self.mEntries.get(fpath)
+            if entry is not None:
+                if entry[0] == file_key:
+                    self.mEntries.move_to_end(fpath)
+                    return entry[1]
+                self._drop(fpath)
+        if file_stat.st_size > self.mMaxFileSize:
+            return None
+        with open(fpath, "rb") as inp:
+            content = inp.read()
+        if len(content) != file_stat.st_size:
+            return None
+        with self.mLock:
+            if fpath in self.mEntries:
+                self._drop(fpath)
+            self.mEntries[fpath] = (file_key, content, dict())
+            self.mSize += len(content)
+            self._shrink()
+        return content
+
+    def _shrink(self):
+        while self.mSize > self.mMaxSize:
+            self._drop(next(iter(self.mEntries)))
+
+    def _drop(self, fpath):
+        _, content, variants = self.mEntries.pop(fpath)
+        self.mSize -= len(content) + sum(
+            len(variant) for variant in variants.values())
+
 #========================================
 class HServHandler:
     sInstance = None
@@ -119,29 +493,107 @@ class HServHandler:
 
     def __init__(self, application, config, in_container):
         self.mApplication = application
-        self.mDirFiles = config["dir-files"]
+        self.mDirFiles = [(entry[0], entry[1],
+            entry[2] if len(entry) > 2 else None)
+            for entry in config["dir-files"]]
+        file_cache_cfg = config.get("file-cache")
+        self.mFileCache = (StaticFileCache(
+            file_cache_cfg.get("max-size", 1 << 26),
+            file_cache_cfg.get("max-file-size", 1 << 20))
+            if file_cache_cfg else None)
+        metrics_cfg = config.get("metrics")
+        self.mMetrics = (HServMetrics(metrics_cfg)
+            if metrics_cfg is not None else None)
+        compression_cfg = config.get("compression")
+        self.mCompressor = (HServCompressor(compression_cfg)
+            if compression_cfg is not None else None)
         self.mHtmlBase = (config["html-base"]
             if in_container else None)
         if self.mHtmlBase and self.mHtmlBase.endswith('/'):
             self.mHtmlBase = self.mHtmlBase[:-1]
+        self.mSpoolMemSize = config.get("spool-mem-size", 1 << 20)
+        self.mRouter = HServRouter(self.mDirFiles)
+        self.mEncoders = HServEncoders(
+            config.get("encoders", dict()), self.getPathKey)
+        admission_cfg = config.get("admission")
+        self.mAdmission = (HServAdmission(admission_cfg)
+            if admission_cfg is not None else None)
+        resp_cache_cfg = config.get("response-cache")
+        self.mRespCache = (HServResponseCache(resp_cache_cfg)
+            if resp_cache_cfg is not None else None)
+        if self.mMetrics is not None:
+            self.mMetrics.addReport("encoders", self.mEncoders.report)
+            if self.mAdmission is not None:
+                self.mMetrics.addReport("admission", self.mAdmission.report)
+            if self.mRespCache is not None:
+                self.mMetrics.addReport("response-cache",
+                    self.mRespCache.report)
         self.mApplication.setup(config, in_container)
+        if hasattr(self.mApplication, "setupRoutes"):
+            self.mApplication.setupRoutes(self.mRouter)
 
     def checkFilePath(self, path):
+        return self._findFilePath(path)[0]
+
+    def _findFilePath(self, path):
         alt_path = self.mApplication.checkFilePath(path)
         if alt_path is not None:
-            return alt_path
-        for path_from, path_to in self.mDirFiles:
-            if path.startswith(path_from):
-                return path_to + path[len(path_from):]
-        return None
+            return alt_path, None
+        return self.mRouter.findStatic(path)[:2]
+
+    def getRouter(self):
+        return self.mRouter
+
+    def _findRoute(self, rq_path, query_args):
+        route, params = self.mRouter.findRoute(rq_path)
+        if route is None:
+            return None
+        if params:
+            query_args.update(params)
+        return route
 
     #===============================================
-    def parseRequest(self, environ):
+    def getRqPath(self, environ):
         rq_path = environ["PATH_INFO"]
         if self.mHtmlBase and rq_path.startswith(self.mHtmlBase):
             rq_path = rq_path[len(self.mHtmlBase):]
         if not rq_path:
             rq_path = "/"
+        return rq_path
+
+    def getPathKey(self, environ):
+        return self.mRouter.getPathKey(self.getRqPath(environ))
+
+    def getMetrics(self):
+        return self.mMetrics
+
+    def getEncoders(self):
+        return self.mEncoders
+
+    def getAdmission(self):
+        return self.mAdmission
+
+    def invalidateCache(self, tag = None):
+        if self.mRespCache is not None:
+            if tag is None:
+                self.mRespCache.clear()
+            else:
+                self.mRespCache.invalidate(tag)
+
+    def getAdmissionClass(self, environ):
+        rq_path = self.getRqPath(environ)
+        return self.mAdmission.getClass(rq_path,
+            self.mRouter.findRoute(rq_path)[0])
+
+    def _makeOverloadResponse(self, environ, start_response):
+        resp_h = HServResponse(start_response, environ)
+        return resp_h.makeResponse(mode = "txt",
+            content = "Server is overloaded, try again later",
+            error = 503, add_headers = [
+                ("Retry-After", str(self.mAdmission.getRetryAfter()))])
+
+    def parseRequest(self, environ):
+        rq_path = self.getRqPath(environ)
         query_string = environ["QUERY_STRING"]
 
         query_args = dict()
@@ -149,43 +601,104 @@ class HServHandler:
             for a, v in parse_qs(query_string).items():
                 query_args[a] = v[0]
 
-        if environ["REQUEST_METHOD"] == "POST":
+        if environ["REQUEST_METHOD"] in ("POST", "PUT"):
             try:
-                forms, files = parse_form_data(environ)
-                for a, v in forms.iterallitems():
-                    query_args[a] = v
-                for ff in files:
-                    if ff.content_type == "application/json":
-                        query_args["@request"] = json.loads(ff.read())
+                self._parseBody(environ, query_args)
             except Exception:
-                logException("Exception on read request body, ",
+                logException("Exception on read request body, "
                     f"ContentType: {environ.get('CONTENT_TYPE')}")
         return rq_path, query_args
 
+    sFormContentTypes = {"", "multipart/form-data",
+        "application/x-www-form-urlencoded"}
+
+    def _parseBody(self, environ, query_args):
+        content_type = environ.get("CONTENT_TYPE", "").partition(
+            ';')[0].strip().lower()
+        if content_type in self.sFormContentTypes:
+            forms, files = parse_form_data(environ,
+                memfile_limit = self.mSpoolMemSize)
+            for a, v in forms.iterallitems():
+                query_args[a] = v
+            for name, ff in files.iterallitems():
+                ff.file.seek(0)
+                if ff.content_type == "application/json":
+                    query_args["@request"] = json_codec.loads(ff.file.read())
+                else:
+                    query_args.setdefault("@files", dict())[name] = ff.file
+        elif content_type == "application/json":
+            query_args["@request"] = json_codec.loads(
+                b"".join(self._iterBody(environ)))
+        else:
+            body = SpooledTemporaryFile(max_size = self.mSpoolMemSize)
+            for chunk in self._iterBody(environ):
+                body.write(chunk)
+            body.seek(0)
+            query_args["@body"] = body
+            if content_type == "application/x-ndjson":
+                query_args["@records"] = self._iterRecords(body)
+
+    @staticmethod
+    def _iterBody(environ, block_size = 1 << 16):
+        inp = environ["wsgi.input"]
+        length = environ.get("CONTENT_LENGTH")
+        if not length:
+            if not environ.get("wsgi.input_terminated"):
+                return
+            length = None
+        else:
+            length = int(length)
+        while length is None or length > 0:
+            chunk = inp.read(block_size if length is None
+                else min(block_size, length))
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+    @staticmethod
+    def _iterRecords(inp):
+        for line in inp:
+            if line.strip():
+                yield json_codec.loads(line)
+
     #===============================================
     def fileResponse(self, resp_h, fpath,
-            query_args, without_decoding):
-        if not os.path.exists(fpath):
+            query_args, without_decoding = True, cache_control = None):
+        try:
+            file_stat = os.stat(fpath)
+        except OSError:
+            return False
+        if not stat.S_ISREG(file_stat.st_mode):
             return False
-        if without_decoding:
-            inp = open(fpath, "rb")
-            content = inp.read()
-        else:
-            with open(fpath, "r", encoding = "utf-8") as inp:
-                content = inp.read()
-        inp.close()
 
         file_ext  = fpath.rpartition('.')[2]
         add_headers = None
 
-        if file_ext == ".xslx":
+        if file_ext == "xlsx":
             add_headers = [("content-disposition",
                 "attachment; filename=%s" %
                 query_args.get("disp", fpath.rpartition('/')[2]))]
 
-        return resp_h.makeResponse(mode = file_ext,
-            content = content, add_headers = add_headers,
-            without_decoding = without_decoding)
+        content, encoding = None, None
+        if self.mFileCache is not None:
+            if "HTTP_RANGE" not in resp_h.mEnviron:
+                encoding = resp_h.getEncoding(file_ext, file_stat.st_size)
+            # Validators go first: 304 response needs no content
+            if not resp_h.isFileNotModified(file_stat, encoding):
+                if encoding is not None:
+                    content = self.mFileCache.getContent(fpath, file_stat,
+                        encoding, self.mCompressor)
+                    if content is None:
+                        encoding = None
+                if content is None:
+                    content = self.mFileCache.getContent(fpath, file_stat)
+
+        return resp_h.makeFileResponse(fpath, file_stat,
+            mode = file_ext, add_headers = add_headers,
+            cache_control = cache_control, content = content,
+            encoding = encoding)
 
     #===============================================
     def _makeResponceException(self, rq_descr, resp_h,
@@ -205,18 +718,59 @@ class HServHandler:
 
     #===============================================
     def processRq(self, environ, start_response):
-        resp_h = HServResponse(start_response)
+        process_f = (self._processRq if self.mAdmission is None
+            else self._admitRq)
+        if self.mMetrics is not None:
+            return self.mMetrics.track(environ, start_response,
+                process_f, self.getPathKey(environ))
+        return process_f(environ, start_response)
+
+    def _admitRq(self, environ, start_response):
+        adm_class = self.getAdmissionClass(environ)
+        if not self.mAdmission.enter(adm_class):
+            return self._makeOverloadResponse(environ, start_response)
+        try:
+            ret = self._processRq(environ, start_response)
+        except BaseException:
+            self.mAdmission.leave(adm_class)
+            raise
+        return self.mAdmission.wrapBody(adm_class, ret, environ)
+
+    def _callHandler(self, resp_h, route, rq_path, query_args, rq_descr):
+        if route is not None:
+            return route.request(resp_h, rq_path, query_args, rq_descr)
+        return self.mApplication.request(
+            resp_h, rq_path, query_args, rq_descr)
+
+    def requestHandler(self, resp_h, environ, route,
+            rq_path, query_args, rq_descr):
+        if self.mRespCache is not None and environ["REQUEST_METHOD"] == "GET":
+            ttl = self.mRespCache.getTTL(rq_path, route)
+            if ttl:
+                return self.mRespCache.process(resp_h,
+                    self.mRespCache.makeKey(environ, rq_path, query_args),
+                    ttl, lambda: self._callHandler(resp_h, route,
+                        rq_path, query_args, rq_descr))
+        return self._callHandler(resp_h, route, rq_path, query_args, rq_descr)
+
+    def _processRq(self, environ, start_response):
+        resp_h = HServResponse(start_response, environ,
+            self.mCompressor, self.mEncoders)
         rq_descr = []
         try:
             rq_path, query_args = self.parseRequest(environ)
-            file_path = self.checkFilePath(rq_path)
+            file_path, cache_control = self._findFilePath(rq_path)
             if file_path is not None:
                 ret = self.fileResponse(resp_h,
-                    file_path, query_args, True)
+                    file_path, query_args, True, cache_control)
                 if ret is not False:
                     return ret
-            return self.mApplication.request(
-                resp_h, rq_path, query_args, rq_descr)
+            route = self._findRoute(rq_path, query_args)
+            if route is not None and not route.acceptsMethod(
+                    environ["REQUEST_METHOD"]):
+                return resp_h.makeResponse(error = 405)
+            return self.requestHandler(resp_h, environ, route,
+                rq_path, query_args, rq_descr)
         except AssertionError as exc:
             return self._makeResponceException(rq_descr, resp_h,
                 exc.args[0] if len(exc.args) > 0 else None)
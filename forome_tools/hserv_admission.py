@@ -0,0 +1,186 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time, threading
+
+from .hserv_router import PrefixTrie
+#===============================================
+class AdmissionClass:
+    def __init__(self, name, config):
+        self.mName = name
+        self.mLimit = config.get("limit", 16)
+        self.mQueueSize = config.get("queue", 0)
+        self.mTimeout = config.get("timeout", 10.)
+        self.mPriority = config.get("priority", 0)
+        self.mActive = 0
+        self.mWaiting = 0
+        self.mCntAdmitted = 0
+        self.mCntQueued = 0
+        self.mCntShedFull = 0
+        self.mCntShedTimeout = 0
+        self.mMaxWait = 0.
+
+    def getName(self):
+        return self.mName
+
+    def getPriority(self):
+        return self.mPriority
+
+    def hasRoom(self):
+        return self.mActive < self.mLimit
+
+    def report(self):
+        return {
+            "limit": self.mLimit,
+            "queue": self.mQueueSize,
+            "priority": self.mPriority,
+            "active": self.mActive,
+            "waiting": self.mWaiting,
+            "admitted": self.mCntAdmitted,
+            "queued": self.mCntQueued,
+            "shed-full": self.mCntShedFull,
+            "shed-timeout": self.mCntShedTimeout,
+            "max-wait-ms": round(1000 * self.mMaxWait, 3)}
+
+#===============================================
+class _AdmittedBody:
+    def __init__(self, admission, adm_class, body):
+        self.mAdmission = admission
+        self.mClass = adm_class
+        self.mBody = body
+
+    def __iter__(self):
+        return iter(self.mBody)
+
+    def close(self):
+        try:
+            if hasattr(self.mBody, "close"):
+                self.mBody.close()
+        finally:
+            if self.mClass is not None:
+                self.mAdmission.leave(self.mClass)
+                self.mClass = None
+
+#===============================================
+class HServAdmission:
+    sFreeBodyKey = "hserv.free_body"
+
+    def __init__(self, config):
+        self.mClasses = {name: AdmissionClass(name, cls_cfg)
+            for name, cls_cfg in config.get("classes", dict()).items()}
+        self.mDefaultClass = config.get("default-class", "default")
+        if self.mDefaultClass not in self.mClasses:
+            self.mClasses[self.mDefaultClass] = AdmissionClass(
+                self.mDefaultClass, dict())
+        self.mPrefixTrie = PrefixTrie()
+        for prefix, name in config.get("prefixes", dict()).items():
+            assert name in self.mClasses, "Unknown admission class: " + name
+            self.mPrefixTrie.add(prefix, name)
+        self.mTotalLimit = config.get("total-limit")
+        self.mRetryAfter = config.get("retry-after", 5)
+        self.mTotalActive = 0
+        self.mWaiters = []
+        self.mWaiterSeq = 0
+        self.mCondition = threading.Condition()
+
+    def getRetryAfter(self):
+        return self.mRetryAfter
+
+    def getClass(self, rq_path, route = None):
+        name = route.getRouteClass() if route is not None else None
+        if name is None:
+            # The longest matching prefix wins
+            for name in self.mPrefixTrie.matches(rq_path):
+                pass
+        adm_class = self.mClasses.get(name) if name is not None else None
+        return (adm_class if adm_class is not None
+            else self.mClasses[self.mDefaultClass])
+
+    def _canEnter(self, waiter):
+        adm_class = waiter[2]
+        if not adm_class.hasRoom() or (self.mTotalLimit is not None
+                and self.mTotalActive >= self.mTotalLimit):
+            return False
+        # Waiters of more important (or earlier) requests that can go
+        # now are served first
+        for other in self.mWaiters:
+            if other[:2] < waiter[:2] and other[2].hasRoom():
+                return False
+        return True
+
+    def _admit(self, adm_class):
+        adm_class.mActive += 1
+        adm_class.mCntAdmitted += 1
+        self.mTotalActive += 1
+
+    def enter(self, adm_class, wait = True):
+        with self.mCondition:
+            self.mWaiterSeq += 1
+            waiter = (adm_class.getPriority(), self.mWaiterSeq, adm_class)
+            if self._canEnter(waiter):
+                self._admit(adm_class)
+                return True
+            if not wait or adm_class.mWaiting >= adm_class.mQueueSize:
+                adm_class.mCntShedFull += 1
+                return False
+            adm_class.mWaiting += 1
+            adm_class.mCntQueued += 1
+            self.mWaiters.append(waiter)
+            time_start = time.monotonic()
+            deadline = time_start + adm_class.mTimeout
+            try:
+                while not self._canEnter(waiter):
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        adm_class.mCntShedTimeout += 1
+                        return False
+                    self.mCondition.wait(timeout)
+                self._admit(adm_class)
+                return True
+            finally:
+                self.mWaiters.remove(waiter)
+                adm_class.mWaiting -= 1
+                adm_class.mMaxWait = max(adm_class.mMaxWait,
+                    time.monotonic() - time_start)
+                self.mCondition.notify_all()
+
+    def leave(self, adm_class):
+        with self.mCondition:
+            adm_class.mActive -= 1
+            self.mTotalActive -= 1
+            self.mCondition.notify_all()
+
+    def wrapBody(self, adm_class, body, environ = None):
+        # The slot is held until the response body is sent: streamed
+        # responses do their work during iteration; files and event
+        # streams are marked free of slot and sent as is
+        if isinstance(body, list) or (environ is not None
+                and environ.get(self.sFreeBodyKey) is body):
+            self.leave(adm_class)
+            return body
+        return _AdmittedBody(self, adm_class, body)
+
+    def report(self):
+        with self.mCondition:
+            return {
+                "total-limit": self.mTotalLimit,
+                "total-active": self.mTotalActive,
+                "classes": {name: adm_class.report()
+                    for name, adm_class in self.mClasses.items()}}
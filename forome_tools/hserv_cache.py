@@ -0,0 +1,188 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time, threading
+from collections import OrderedDict
+
+from .hserv_router import PrefixTrie
+#===============================================
+class _Flight:
+    def __init__(self):
+        self.mEvent = threading.Event()
+        self.mResult = None
+        self.mPassThrough = False
+
+#===============================================
+class HServResponseCache:
+    def __init__(self, config):
+        self.mMaxSize = config.get("max-size", 1 << 26)
+        self.mMaxEntries = config.get("max-entries", 10000)
+        self.mWaitTimeout = config.get("wait-timeout", 30.)
+        self.mPathTrie = PrefixTrie()
+        for prefix, ttl in config.get("paths", dict()).items():
+            self.mPathTrie.add(prefix, ttl)
+        self.mEntries = OrderedDict()
+        self.mSize = 0
+        self.mTagKeys = dict()
+        self.mTagInvalidSeq = dict()
+        self.mSeq = 0
+        self.mClearSeq = -1
+        self.mInFlight = dict()
+        self.mLock = threading.Lock()
+        self.mCntHits = 0
+        self.mCntMisses = 0
+        self.mCntCoalesced = 0
+        self.mCntInvalidated = 0
+
+    def getTTL(self, rq_path, route = None):
+        ttl = route.getCacheTTL() if route is not None else None
+        if ttl is None:
+            # The longest matching prefix wins
+            for ttl in self.mPathTrie.matches(rq_path):
+                pass
+        return ttl
+
+    @staticmethod
+    def makeKey(environ, rq_path, query_args):
+        # Response depends on negotiated content type and encoding too
+        return (rq_path, tuple(sorted(query_args.items())),
+            environ.get("HTTP_ACCEPT"), environ.get("HTTP_ACCEPT_ENCODING"))
+
+    def process(self, resp_h, key, ttl, compute_f):
+        start_response = resp_h.mStartResponse
+        while True:
+            with self.mLock:
+                entry = self._getEntry(key)
+                if entry is not None:
+                    self.mCntHits += 1
+                    return self._replay(start_response, entry[1])
+                flight = self.mInFlight.get(key)
+                if flight is None:
+                    flight = self.mInFlight[key] = _Flight()
+                    start_seq = self.mSeq
+                    self.mCntMisses += 1
+                    break
+                self.mCntCoalesced += 1
+            if (not flight.mEvent.wait(self.mWaitTimeout)
+                    or flight.mPassThrough):
+                return compute_f()
+            if flight.mResult is not None:
+                return self._replay(start_response, flight.mResult)
+        response = dict()
+
+        def _start_response(status, headers, exc_info = None):
+            response["status"], response["headers"] = status, headers
+
+        resp_h.mStartResponse = _start_response
+        body = None
+        try:
+            body = compute_f()
+        finally:
+            resp_h.mStartResponse = start_response
+            if "status" not in response or not isinstance(body, list):
+                flight.mPassThrough = True
+                with self.mLock:
+                    del self.mInFlight[key]
+                flight.mEvent.set()
+        if "status" not in response:
+            return body
+        if not isinstance(body, list):
+            # Streamed response is passed as is, without caching
+            start_response(response["status"], response["headers"])
+            return body
+        result = (response["status"], response["headers"], b"".join(body))
+        flight.mResult = result
+        with self.mLock:
+            if result[0].startswith("200"):
+                self._store(key, ttl, result, resp_h.getCacheTags(), start_seq)
+            del self.mInFlight[key]
+        flight.mEvent.set()
+        return self._replay(start_response, result)
+
+    @staticmethod
+    def _replay(start_response, result):
+        status, headers, content = result
+        start_response(status, list(headers))
+        return [content]
+
+    def _getEntry(self, key):
+        entry = self.mEntries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self.mEntries.move_to_end(key)
+        return entry
+
+    def _store(self, key, ttl, result, tags, start_seq):
+        if start_seq <= self.mClearSeq:
+            return
+        for tag in tags:
+            # Invalidated while the response was evaluated
+            if self.mTagInvalidSeq.get(tag, -1) >= start_seq:
+                return
+        if len(result[2]) > self.mMaxSize:
+            return
+        if key in self.mEntries:
+            self._drop(key)
+        self.mEntries[key] = (time.monotonic() + ttl, result, tags)
+        self.mSize += len(result[2])
+        for tag in tags:
+            self.mTagKeys.setdefault(tag, set()).add(key)
+        while (self.mSize > self.mMaxSize
+                or len(self.mEntries) > self.mMaxEntries):
+            self._drop(next(iter(self.mEntries)))
+
+    def _drop(self, key):
+        _, result, tags = self.mEntries.pop(key)
+        self.mSize -= len(result[2])
+        for tag in tags:
+            keys = self.mTagKeys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.mTagKeys[tag]
+
+    def invalidate(self, tag):
+        with self.mLock:
+            self.mTagInvalidSeq[tag] = self.mSeq
+            self.mSeq += 1
+            for key in list(self.mTagKeys.get(tag, [])):
+                self._drop(key)
+                self.mCntInvalidated += 1
+
+    def clear(self):
+        with self.mLock:
+            self.mClearSeq = self.mSeq
+            self.mSeq += 1
+            for key in list(self.mEntries.keys()):
+                self._drop(key)
+
+    def report(self):
+        with self.mLock:
+            return {
+                "entries": len(self.mEntries),
+                "size": self.mSize,
+                "in-flight": len(self.mInFlight),
+                "hits": self.mCntHits,
+                "misses": self.mCntMisses,
+                "coalesced": self.mCntCoalesced,
+                "invalidated": self.mCntInvalidated}
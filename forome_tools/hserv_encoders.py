@@ -0,0 +1,137 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json, time, threading
+
+from . import json_codec
+#===============================================
+class EncodeStat:
+    def __init__(self):
+        self.mCount = 0
+        self.mTotalTime = 0.
+        self.mMaxTime = 0.
+        self.mBytes = 0
+
+    def add(self, elapsed_ms, size):
+        self.mCount += 1
+        self.mTotalTime += elapsed_ms
+        self.mMaxTime = max(self.mMaxTime, elapsed_ms)
+        self.mBytes += size
+
+    def report(self):
+        cnt = max(1, self.mCount)
+        return {
+            "count": self.mCount,
+            "avg-ms": round(self.mTotalTime / cnt, 3),
+            "max-ms": round(self.mMaxTime, 3),
+            "bytes": self.mBytes,
+            "avg-bytes": self.mBytes // cnt}
+
+#===============================================
+class HServEncoders:
+    sOtherPath = "<other>"
+    sMediaModes = {
+        "application/json": "json",
+        "application/bson": "bson",
+        "application/*":    "json",
+        "*/*":              "json"}
+
+    def __init__(self, config, path_key_f = None):
+        self.mPathKeyF = path_key_f
+        self.mMaxPaths = config.get("max-paths", 1000)
+        self.mFastJSon = (config.get("fast-json", True)
+            and json_codec.getBackend() != "json")
+        self.mBsonEncodeF = None
+        if config.get("bson", True):
+            try:
+                from .bson_adapter import BsonAdapter
+                self.mBsonEncodeF = BsonAdapter.encode
+            except ImportError:
+                pass
+        self.mStat = dict()
+        self.mLock = threading.Lock()
+
+    def getModes(self):
+        return ["json"] + (["bson"] if self.mBsonEncodeF is not None else [])
+
+    def selectMode(self, accept):
+        if not accept:
+            return "json"
+        best_mode, best_quality = None, 0.
+        for item in accept.split(','):
+            media, _, params = item.partition(';')
+            mode = self.sMediaModes.get(media.strip().lower())
+            if mode is None or (mode == "bson"
+                    and self.mBsonEncodeF is None):
+                continue
+            quality = 1.
+            for param in params.split(';'):
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0.
+            if quality > best_quality:
+                best_mode, best_quality = mode, quality
+        return best_mode if best_mode is not None else "json"
+
+    def encodeJSon(self, obj):
+        if self.mFastJSon:
+            return json_codec.dumpsBytes(obj)
+        # "fast-json": false keeps standard json regardless of backends
+        return json.dumps(obj, ensure_ascii = False).encode("utf-8")
+
+    def encode(self, obj, mode, environ = None):
+        tm0 = time.perf_counter()
+        if mode == "bson":
+            rep = self.mBsonEncodeF(obj)
+        else:
+            assert mode == "json", "Unsupported encoding mode: " + mode
+            rep = self.encodeJSon(obj)
+        elapsed_ms = 1000 * (time.perf_counter() - tm0)
+        path_key = None
+        if environ is not None:
+            path_key = (self.mPathKeyF(environ) if self.mPathKeyF
+                else environ.get("PATH_INFO"))
+        self._record(path_key or self.sOtherPath, mode, elapsed_ms, len(rep))
+        return rep
+
+    def _record(self, path_key, mode, elapsed_ms, size):
+        with self.mLock:
+            path_stat = self.mStat.get(path_key)
+            if path_stat is None:
+                if len(self.mStat) >= self.mMaxPaths:
+                    path_key = self.sOtherPath
+                path_stat = self.mStat.setdefault(path_key, dict())
+            stat = path_stat.get(mode)
+            if stat is None:
+                stat = path_stat[mode] = EncodeStat()
+            stat.add(elapsed_ms, size)
+
+    def report(self):
+        with self.mLock:
+            return {
+                "modes": self.getModes(),
+                "fast-json": (json_codec.getBackend()
+                    if self.mFastJSon else None),
+                "routes": {path_key: {mode: stat.report()
+                    for mode, stat in path_stat.items()}
+                    for path_key, path_stat in self.mStat.items()}}
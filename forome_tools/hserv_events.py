@@ -0,0 +1,156 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time, asyncio
+
+from . import json_codec
+#===============================================
+class TaskEventsRoute:
+    def __init__(self, job_pool, uid_arg = "task", heartbeat = 15.,
+            max_duration = 3600., max_poll = 30., send_result = False,
+            async_poll = .5):
+        self.mJobPool = job_pool
+        self.mUidArg = uid_arg
+        self.mHeartbeat = heartbeat
+        self.mMaxDuration = max_duration
+        self.mMaxPoll = max_poll
+        self.mSendResult = send_result
+        self.mAsyncPoll = async_poll
+
+    def _makeInfo(self, info):
+        result, status, version = info
+        ret = {"status": status, "version": version,
+            "done": result is not False}
+        if result is not False and self.mSendResult:
+            ret["result"] = result
+        return ret
+
+    @staticmethod
+    def _makeEvent(event_type, data, event_id = None):
+        lines = []
+        if event_id is not None:
+            lines.append("id: %d" % event_id)
+        lines.append("event: " + event_type)
+        lines.append("data: " + json_codec.dumps(data))
+        return "\n".join(lines) + "\n\n"
+
+    def _makeStepEvent(self, task_uid, version, info):
+        # Returns event and new version, None version ends the stream
+        if info is None:
+            return self._makeEvent("lost", {"task": str(task_uid)}), None
+        if info[0] is not False:
+            return (self._makeEvent("done", self._makeInfo(info), info[2]),
+                None)
+        if info[2] > version:
+            return (self._makeEvent("status", self._makeInfo(info),
+                info[2]), info[2])
+        return ": heartbeat\n\n", version
+
+    def _iterEvents(self, task_uid, version):
+        time_end = time.monotonic() + self.mMaxDuration
+        while version is not None:
+            event, version = self._makeStepEvent(task_uid, version,
+                self.mJobPool.waitStatusChange(
+                    task_uid, version, self.mHeartbeat))
+            yield event
+            if time.monotonic() > time_end:
+                # Client reconnects with Last-Event-ID
+                return
+
+    async def _waitStatusAsync(self, task_uid, version, timeout):
+        # Event loop can not wait on task condition, so status is polled
+        time_end = time.monotonic() + timeout
+        while True:
+            info = self.mJobPool.waitStatusChange(task_uid, version, 0)
+            time_left = time_end - time.monotonic()
+            if (info is None or info[0] is not False or info[2] > version
+                    or time_left <= 0):
+                return info
+            await asyncio.sleep(min(self.mAsyncPoll, time_left))
+
+    async def _iterEventsAsync(self, task_uid, version):
+        time_end = time.monotonic() + self.mMaxDuration
+        while version is not None:
+            event, version = self._makeStepEvent(task_uid, version,
+                await self._waitStatusAsync(
+                    task_uid, version, self.mHeartbeat))
+            yield event
+            if time.monotonic() > time_end:
+                return
+
+    def _parseArgs(self, resp_h, query_args):
+        try:
+            task_uid = int(query_args[self.mUidArg])
+            since_version = (int(query_args["since"])
+                if "since" in query_args else None)
+            timeout = min(self.mMaxPoll,
+                float(query_args.get("timeout", self.mMaxPoll)))
+        except (KeyError, ValueError):
+            return None
+        try:
+            last_version = int(
+                resp_h.mEnviron.get("HTTP_LAST_EVENT_ID") or -1)
+        except ValueError:
+            last_version = -1
+        return task_uid, since_version, timeout, last_version
+
+    @staticmethod
+    def _badArgsResponse(resp_h):
+        return resp_h.makeResponse(mode = "txt",
+            content = "Bad task arguments", error = 400)
+
+    def _pollResponse(self, resp_h, info):
+        if info is None:
+            return resp_h.makeResponse(error = 404)
+        return resp_h.makeObjResponse(self._makeInfo(info))
+
+    @staticmethod
+    def _streamResponse(resp_h, events):
+        # Stream is long, it does not hold admission slot
+        return resp_h.makeStreamResponse(events, mode = "sse",
+            chunk_size = 1, raw_chunks = True, hold_slot = False,
+            add_headers = [
+                ("Cache-Control", "no-cache"),
+                ("X-Accel-Buffering", "no")])
+
+    def request(self, resp_h, rq_path, query_args, rq_descr):
+        args = self._parseArgs(resp_h, query_args)
+        if args is None:
+            return self._badArgsResponse(resp_h)
+        task_uid, since_version, timeout, last_version = args
+        rq_descr.append("task=%d" % task_uid)
+        if since_version is not None:
+            # Long-poll mode: one response per status change
+            return self._pollResponse(resp_h, self.mJobPool.waitStatusChange(
+                task_uid, since_version, timeout))
+        return self._streamResponse(resp_h,
+            self._iterEvents(task_uid, last_version))
+
+    async def requestAsync(self, resp_h, rq_path, query_args, rq_descr):
+        args = self._parseArgs(resp_h, query_args)
+        if args is None:
+            return self._badArgsResponse(resp_h)
+        task_uid, since_version, timeout, last_version = args
+        rq_descr.append("task=%d" % task_uid)
+        if since_version is not None:
+            return self._pollResponse(resp_h, await self._waitStatusAsync(
+                task_uid, since_version, timeout))
+        return self._streamResponse(resp_h,
+            self._iterEventsAsync(task_uid, last_version))
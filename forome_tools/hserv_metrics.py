@@ -0,0 +1,229 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os, re, time, logging, threading, cProfile
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime
+
+from . import json_codec
+#===============================================
+class RouteStat:
+    sBuckets = (1, 2, 5, 10, 20, 50, 100, 200, 500,
+        1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.mCount = 0
+        self.mTotalTime = 0.
+        self.mMaxTime = 0.
+        self.mHist = [0] * (len(self.sBuckets) + 1)
+        self.mStatusCounts = defaultdict(int)
+        self.mRqBytes = 0
+        self.mRespBytes = 0
+
+    def add(self, status, elapsed_ms, rq_size, resp_size):
+        self.mCount += 1
+        self.mTotalTime += elapsed_ms
+        self.mMaxTime = max(self.mMaxTime, elapsed_ms)
+        self.mHist[bisect_left(self.sBuckets, elapsed_ms)] += 1
+        self.mStatusCounts[status] += 1
+        self.mRqBytes += rq_size
+        self.mRespBytes += resp_size
+
+    def report(self):
+        hist = dict()
+        for idx, cnt in enumerate(self.mHist):
+            if cnt > 0:
+                hist["<=%d" % self.sBuckets[idx] if idx < len(self.sBuckets)
+                    else ">%d" % self.sBuckets[-1]] = cnt
+        return {
+            "count": self.mCount,
+            "avg-ms": round(self.mTotalTime / max(1, self.mCount), 3),
+            "max-ms": round(self.mMaxTime, 3),
+            "hist-ms": hist,
+            "status": dict(self.mStatusCounts),
+            "request-bytes": self.mRqBytes,
+            "response-bytes": self.mRespBytes}
+
+#===============================================
+class _TrackedBody:
+    def __init__(self, body, done_f):
+        self.mBody = body
+        self.mDoneF = done_f
+        self.mSize = 0
+
+    def __iter__(self):
+        for chunk in self.mBody:
+            self.mSize += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.mBody, "close"):
+                self.mBody.close()
+        finally:
+            if self.mDoneF is not None:
+                self.mDoneF(self.mSize)
+                self.mDoneF = None
+
+class _TrackedAsyncBody(_TrackedBody):
+    async def _iterAsync(self):
+        async for chunk in self.mBody:
+            self.mSize += len(chunk)
+            yield chunk
+
+    def __aiter__(self):
+        return self._iterAsync()
+
+    async def aclose(self):
+        try:
+            if hasattr(self.mBody, "aclose"):
+                await self.mBody.aclose()
+        finally:
+            if self.mDoneF is not None:
+                self.mDoneF(self.mSize)
+                self.mDoneF = None
+
+#===============================================
+class HServMetrics:
+    sOtherPath = "<other>"
+    sFNamePatt = re.compile(r"[^\w.-]+")
+
+    def __init__(self, config):
+        self.mPath = config.get("path", "/_metrics")
+        self.mMaxPaths = config.get("max-paths", 1000)
+        self.mSlowMs = config.get("slow-ms")
+        self.mProfileEvery = config.get("profile-every", 0)
+        self.mProfileSlowMs = config.get("profile-slow-ms")
+        self.mProfileDir = config.get("profile-dir")
+        if self.mProfileEvery > 0:
+            assert self.mProfileDir, "Metrics: profile-dir is required"
+            os.makedirs(self.mProfileDir, exist_ok = True)
+        self.mStat = dict()
+        self.mRqCount = 0
+        self.mLock = threading.Lock()
+        # Only one profiler can be active in process at a time
+        self.mProfileLock = threading.Lock()
+        self.mExtraReports = dict()
+
+    def getPath(self):
+        return self.mPath
+
+    def addReport(self, name, report_f):
+        self.mExtraReports[name] = report_f
+
+    def record(self, path_key, status, elapsed_ms, rq_size, resp_size):
+        with self.mLock:
+            stat = self.mStat.get(path_key)
+            if stat is None:
+                if len(self.mStat) >= self.mMaxPaths:
+                    path_key = self.sOtherPath
+                stat = self.mStat.setdefault(path_key, RouteStat())
+            stat.add(status, elapsed_ms, rq_size, resp_size)
+        if self.mSlowMs is not None and elapsed_ms >= self.mSlowMs:
+            logging.warning("Slow request: %s %d ms, status %s"
+                % (path_key, int(elapsed_ms), status))
+
+    def report(self):
+        with self.mLock:
+            ret = {"routes": {path_key: stat.report()
+                for path_key, stat in self.mStat.items()}}
+        for name, report_f in self.mExtraReports.items():
+            ret[name] = report_f()
+        return ret
+
+    def _needsProfile(self):
+        if self.mProfileEvery <= 0:
+            return False
+        with self.mLock:
+            self.mRqCount += 1
+            if self.mRqCount % self.mProfileEvery != 0:
+                return False
+        return self.mProfileLock.acquire(blocking = False)
+
+    def _saveProfile(self, profiler, path_key, elapsed_ms):
+        fname = "%s-%dms-%s.prof" % (
+            datetime.now().strftime("%Y%m%d-%H%M%S-%f"), int(elapsed_ms),
+            self.sFNamePatt.sub('_', path_key).strip('_')[:80])
+        try:
+            profiler.dump_stats(os.path.join(self.mProfileDir, fname))
+        except Exception:
+            logging.exception("Failed to save profile")
+
+    @staticmethod
+    def getBodySize(headers, ret):
+        for name, value in headers:
+            if name.lower() == "content-length":
+                return int(value)
+        if isinstance(ret, list):
+            return sum(len(chunk) for chunk in ret)
+        return 0
+
+    def trackBody(self, environ, path_key, response, tm0, ret):
+        # Streamed bodies are measured when they are sent
+        rq_size = int(environ.get("CONTENT_LENGTH") or 0)
+
+        def _done(resp_size):
+            self.record(path_key,
+                response.get("status", "-").partition(' ')[0],
+                1000 * (time.perf_counter() - tm0), rq_size, resp_size)
+
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(ret, list) or (isinstance(file_wrapper, type)
+                and isinstance(ret, file_wrapper)):
+            # File wrapper is kept as is, so server can use sendfile
+            _done(self.getBodySize(response.get("headers", []), ret))
+            return ret
+        if hasattr(ret, "__aiter__"):
+            return _TrackedAsyncBody(ret, _done)
+        return _TrackedBody(ret, _done)
+
+    def track(self, environ, start_response, process_f, path_key = None):
+        if path_key is None:
+            path_key = environ.get("PATH_INFO", "/")
+        if path_key == self.mPath:
+            content = json_codec.dumpsBytes(self.report(), indent = 2)
+            start_response("200 OK", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(content)))])
+            return [content]
+        response = dict()
+
+        def _start_response(status, headers, exc_info = None):
+            response["status"], response["headers"] = status, headers
+            return start_response(status, headers, exc_info)
+
+        profiler = None
+        if self._needsProfile():
+            profiler = cProfile.Profile()
+        tm0 = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            ret = process_f(environ, _start_response)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.mProfileLock.release()
+        elapsed_ms = 1000 * (time.perf_counter() - tm0)
+        if profiler is not None and (self.mProfileSlowMs is None
+                or elapsed_ms >= self.mProfileSlowMs):
+            self._saveProfile(profiler, path_key, elapsed_ms)
+        return self.trackBody(environ, path_key, response, tm0, ret)
@@ -0,0 +1,177 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import inspect
+#===============================================
+class PrefixTrie:
+    def __init__(self):
+        self.mRoot = dict()
+
+    def add(self, prefix, value):
+        node = self.mRoot
+        for ch in prefix:
+            node = node.setdefault(ch, dict())
+        if None not in node:
+            node[None] = value
+
+    def matches(self, path):
+        node = self.mRoot
+        if None in node:
+            yield node[None]
+        for ch in path:
+            node = node.get(ch)
+            if node is None:
+                return
+            if None in node:
+                yield node[None]
+
+#===============================================
+class HServRoute:
+    def __init__(self, pattern, handler, methods = None, route_class = None,
+            cache_ttl = None):
+        self.mPattern = pattern
+        self.mHandler = handler
+        self.mMethods = set(methods) if methods else None
+        self.mRouteClass = route_class
+        self.mCacheTTL = cache_ttl
+        if hasattr(handler, "request") or hasattr(handler, "requestAsync"):
+            self.mSyncF = getattr(handler, "request", None)
+            self.mAsyncF = getattr(handler, "requestAsync", None)
+        elif inspect.iscoroutinefunction(handler):
+            self.mSyncF, self.mAsyncF = None, handler
+        else:
+            self.mSyncF, self.mAsyncF = handler, None
+        # Response cache evaluates handlers in threads, not in event loop
+        assert cache_ttl is None or self.mAsyncF is None, (
+            "Async route can not be cached: " + pattern)
+
+    def getPattern(self):
+        return self.mPattern
+
+    def getRouteClass(self):
+        return self.mRouteClass
+
+    def getCacheTTL(self):
+        return self.mCacheTTL
+
+    def isAsync(self):
+        return self.mAsyncF is not None
+
+    def acceptsMethod(self, method):
+        return self.mMethods is None or method in self.mMethods
+
+    def request(self, resp_h, rq_path, query_args, rq_descr):
+        if self.mSyncF is None:
+            assert False, "Route %s supports only async mode" % self.mPattern
+        return self.mSyncF(resp_h, rq_path, query_args, rq_descr)
+
+    async def requestAsync(self, resp_h, rq_path, query_args, rq_descr):
+        return await self.mAsyncF(resp_h, rq_path, query_args, rq_descr)
+
+#===============================================
+class HServRouter:
+    sParamKey = "{}"
+
+    def __init__(self, dir_files):
+        self.mDirFiles = dir_files
+        self.mStaticTrie = PrefixTrie()
+        for idx, entry in enumerate(dir_files):
+            self.mStaticTrie.add(entry[0], idx)
+        self.mExactRoutes = dict()
+        self.mRouteTree = dict()
+
+    def addRoute(self, pattern, handler, methods = None, route_class = None,
+            cache_ttl = None):
+        assert pattern.startswith('/'), "Bad route pattern: " + pattern
+        route = HServRoute(pattern, handler, methods, route_class, cache_ttl)
+        if '{' not in pattern:
+            assert pattern not in self.mExactRoutes, (
+                "Duplicate route: " + pattern)
+            self.mExactRoutes[pattern] = route
+            return route
+        node = self.mRouteTree
+        param_names = []
+        for segment in pattern[1:].split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                param_names.append(segment[1:-1])
+                segment = self.sParamKey
+            node = node.setdefault(segment, dict())
+        assert None not in node, "Duplicate route: " + pattern
+        node[None] = (route, param_names)
+        return route
+
+    def hasAsyncRoutes(self):
+        if any(route.isAsync() for route in self.mExactRoutes.values()):
+            return True
+        stack = [self.mRouteTree]
+        while stack:
+            node = stack.pop()
+            for key, value in node.items():
+                if key is None:
+                    if value[0].isAsync():
+                        return True
+                else:
+                    stack.append(value)
+        return False
+
+    def findStatic(self, path):
+        # The first dir-files entry wins, as in linear scan of the list
+        indexes = list(self.mStaticTrie.matches(path))
+        if len(indexes) == 0:
+            return None, None, None
+        path_from, path_to, cache_control = self.mDirFiles[min(indexes)]
+        return path_to + path[len(path_from):], cache_control, path_from
+
+    def findRoute(self, path):
+        route = self.mExactRoutes.get(path)
+        if route is not None:
+            return route, None
+        params = []
+        node = self._matchNode(self.mRouteTree, path[1:].split('/'), 0, params)
+        if node is None:
+            return None, None
+        route, param_names = node[None]
+        return route, dict(zip(param_names, params))
+
+    def _matchNode(self, node, segments, idx, params):
+        if idx == len(segments):
+            return node if None in node else None
+        next_node = node.get(segments[idx])
+        if next_node is not None:
+            ret = self._matchNode(next_node, segments, idx + 1, params)
+            if ret is not None:
+                return ret
+        next_node = node.get(self.sParamKey)
+        if next_node is not None:
+            params.append(segments[idx])
+            ret = self._matchNode(next_node, segments, idx + 1, params)
+            if ret is not None:
+                return ret
+            params.pop()
+        return None
+
+    def getPathKey(self, path):
+        route, _ = self.findRoute(path)
+        if route is not None:
+            return route.getPattern()
+        static_prefix = self.findStatic(path)[2]
+        if static_prefix is not None:
+            return static_prefix + "*"
+        return path
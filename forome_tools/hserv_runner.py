@@ -0,0 +1,180 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os, gc, time, socket, signal, logging, threading
+import logging.config
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from .hserv import HServHandler
+#========================================
+class _RequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+#========================================
+class PooledWSGIServer(WSGIServer):
+    def __init__(self, sock, thread_count, queue_size):
+        WSGIServer.__init__(self, sock.getsockname()[:2],
+            _RequestHandler, bind_and_activate = False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()[:2]
+        host, port = self.server_address
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(HServHandler.request)
+        self.mExecutor = ThreadPoolExecutor(thread_count,
+            thread_name_prefix = "hserv")
+        # Accept loop waits for a free slot, so excess connections stay
+        # in listen backlog instead of unbounded executor queue
+        self.mSlots = threading.BoundedSemaphore(thread_count + queue_size)
+
+    def _processRequest(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.mSlots.release()
+
+    def process_request(self, request, client_address):
+        self.mSlots.acquire()
+        try:
+            self.mExecutor.submit(self._processRequest,
+                request, client_address)
+        except BaseException:
+            self.mSlots.release()
+            raise
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self.mExecutor.shutdown(wait = False)
+
+#========================================
+class PreforkRunner:
+    sRestartDelay = 1.
+
+    def __init__(self, application, config):
+        assert hasattr(os, "fork"), "Prefork mode requires os.fork()"
+        server_cfg = config.get("server", dict())
+        self.mApplication = application
+        self.mConfig = config
+        self.mAddress = (config["host"], int(config["port"]))
+        self.mWorkerCount = server_cfg.get("workers", os.cpu_count())
+        self.mThreadCount = server_cfg.get("threads", 8)
+        self.mQueueSize = server_cfg.get("queue", self.mThreadCount)
+        self.mReusePort = server_cfg.get("reuse-port", False)
+        self.mPreload = server_cfg.get("preload", False)
+        self.mBacklog = server_cfg.get("backlog", 128)
+        self.mSocket = None
+        self.mWorkers = dict()
+        self.mTerminating = False
+
+    def _makeSocket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.mReusePort:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.mAddress)
+        sock.listen(self.mBacklog)
+        return sock
+
+    def _spawnWorker(self, worker_no):
+        pid = os.fork()
+        if pid != 0:
+            self.mWorkers[pid] = (worker_no, time.monotonic())
+            return
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if not self.mPreload:
+                HServHandler.init(self.mApplication, self.mConfig, False)
+            if hasattr(self.mApplication, "setupWorker"):
+                self.mApplication.setupWorker(worker_no)
+            sock = self.mSocket if self.mSocket else self._makeSocket()
+            server = PooledWSGIServer(sock,
+                self.mThreadCount, self.mQueueSize)
+            server.serve_forever()
+        except Exception:
+            logging.exception("HServ worker %d failed" % worker_no)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _terminate(self, signum, frame):
+        self.mTerminating = True
+        for pid in list(self.mWorkers.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        if self.mPreload:
+            HServHandler.init(self.mApplication, self.mConfig, False)
+            # Threads do not survive fork: job pools and so on
+            # must be started in setupWorker()
+            assert threading.active_count() == 1, (
+                "Preload is not possible, application started threads: "
+                + ", ".join(thr.name for thr in threading.enumerate()
+                    if thr is not threading.current_thread()))
+        if not self.mReusePort:
+            self.mSocket = self._makeSocket()
+        # Objects loaded so far stay shared by workers copy-on-write
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        logging.info("HServ on %s:%d: %d workers, %d threads each"
+            % (self.mAddress[0], self.mAddress[1],
+            self.mWorkerCount, self.mThreadCount))
+        for worker_no in range(self.mWorkerCount):
+            self._spawnWorker(worker_no)
+        while self.mWorkers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_no, start_time = self.mWorkers.pop(pid, (None, None))
+            if worker_no is None or self.mTerminating:
+                continue
+            logging.error("HServ worker %d (pid %d) exited with status %d"
+                % (worker_no, pid, status))
+            if time.monotonic() - start_time < self.sRestartDelay:
+                time.sleep(self.sRestartDelay)
+            if not self.mTerminating:
+                self._spawnWorker(worker_no)
+        if self.mSocket is not None:
+            self.mSocket.close()
+
+#========================================
+def runHServer(application, config):
+    logging_config = config.get("logging")
+    if logging_config:
+        logging.config.dictConfig(logging_config)
+        logging.basicConfig(level = 0)
+    PreforkRunner(application, config).run()
@@ -18,8 +18,9 @@
 #  limitations under the License.
 #
 
-import sys, os, json, re
+import sys, os, re
 from datetime import datetime
+from . import json_codec
 from .json_conf import readCommentedJSon
 #========================================
 def _processAlias(content, alias_name, alias_value, aliases_done):
@@ -74,7 +75,7 @@ def loadDatasetInventory(inv_file):
     content = _processAlias(content, "DIR", dir_path, aliases_done)
     content = _processAlias(content, "TS", genTS(), aliases_done)
 
-    pre_config = json.loads(content)
+    pre_config = json_codec.loads(content)
 
     # Replace predefined names
     for key, value in pre_config.get("aliases", dict()).items():
@@ -95,4 +96,4 @@ def loadDatasetInventory(inv_file):
             content = _processAlias(content, key, value, aliases_done)
 
     # Ready to go
-    return json.loads(content)
+    return json_codec.loads(content)
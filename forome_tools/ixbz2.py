@@ -18,7 +18,7 @@
 #  limitations under the License.
 #
 
-import bz2, threading
+import os, bz2, threading
 from time import time
 from array import array
 from bisect import bisect
@@ -57,10 +57,22 @@ class IndexBZ2:
         return self.mTotalCount
 
     def _read(self, pos, length):
+        # pread() does not use file offset, so handle is safe to share
+        # between threads and forked processes
+        if hasattr(os, "pread"):
+            return os.pread(self.mFile.fileno(), length, pos)
         with self.mLock:
             self.mFile.seek(pos)
             return self.mFile.read(length)
 
+    def __iter__(self):
+        for chunk_idx in range(0, len(self.mIdxTable), 4):
+            start, count, pos, length = self.mIdxTable[
+                chunk_idx: chunk_idx + 4]
+            chunk_lines = bz2.decompress(
+                self._read(pos, length)).decode('utf-8').split('\n')
+            yield from chunk_lines[:count]
+
     def __getitem__(self, idx):
         chunk_idx = 4 * (bisect(self.mChunks, idx) - 1)
         start, count, pos, length = self.mIdxTable[chunk_idx: chunk_idx + 4]
@@ -18,41 +18,111 @@
 #  limitations under the License.
 #
 
-import threading, abc, time
+import os, threading, abc, time, heapq, random
 from uuid import uuid4
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from .log_err import logException
+from .result_store import ResultStore
+#===============================================
+def _currentRSS():
+    try:
+        with open("/proc/self/statm", "r") as inp:
+            return int(inp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    return _maxRSS()
+
+def _maxRSS():
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 #===============================================
 class ExecutionTask:
-    def __init__(self, descr):
+    def __init__(self, descr, mem_estimate = 0):
         self.mUID = uuid4().int
         self.mDescr = descr
+        self.mMemEstimate = mem_estimate
         self.mStatus = "Waiting for start..."
+        self.mStatusCondition = threading.Condition()
+        self.mStatusVersion = 0
+        self.mDone = False
         self.mPool = None
+        self.mPrereqUIDs = []
+        self.mPrereqResults = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["mStatusCondition"]
+        state["mPool"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mStatusCondition = threading.Condition()
 
     def _reset(self):
         assert self.mPool is None
-        self.mStatus = "Waiting for start..."
+        with self.mStatusCondition:
+            self.mStatus = "Waiting for start..."
+            self.mStatusVersion += 1
+            self.mDone = False
+        self.mPrereqResults = dict()
 
     def _setPool(self, pool):
         self.mPool = pool
 
+    def _setPrereqResult(self, task_uid, result):
+        self.mPrereqResults[task_uid] = result
+
+    def _markDone(self):
+        with self.mStatusCondition:
+            self.mDone = True
+            self.mStatusVersion += 1
+            self.mStatusCondition.notify_all()
+            return self.mStatusVersion
+
+    def getPrereqUIDs(self):
+        return self.mPrereqUIDs
+
+    def getPrereqResults(self):
+        return [ResultStore.load(self.mPrereqResults.get(task_uid))
+            for task_uid in self.mPrereqUIDs]
+
     def getUID(self):
         return self.mUID
 
     def getDescr(self):
         return self.mDescr
 
+    def getMemEstimate(self):
+        return self.mMemEstimate
+
     def getStatus(self):
         return self.mStatus
 
+    def getStatusInfo(self):
+        with self.mStatusCondition:
+            return self.mStatus, self.mStatusVersion
+
     def setStatus(self, status):
-        if self.mPool:
-            with self.mPool.getLock():
-                self.mStatus = status
-        else:
+        with self.mStatusCondition:
             self.mStatus = status
+            self.mStatusVersion += 1
+            self.mStatusCondition.notify_all()
+
+    def waitStatusChange(self, since_version, timeout):
+        with self.mStatusCondition:
+            self.mStatusCondition.wait_for(lambda: self.mDone
+                or self.mStatusVersion > since_version, timeout)
+            return self.mStatusVersion
 
     @abc.abstractmethod
     def getTaskType(self):
@@ -68,21 +138,32 @@ class TaskHandler:
         self.mTask     = task
         self.mOrdNo    = ord_no
         self.mPriority = priority
+        self.mPending  = set()
+        self.mBypassCount = 0
+
+    def getTask(self):
+        return self.mTask
 
     def getOrd(self):
         return (self.mPriority, self.mOrdNo)
 
     def execIt(self, pool):
-        result = None
+        result, failed = None, False
+        rss_start, max_rss_start = _currentRSS(), _maxRSS()
         try:
             self.mTask._setPool(pool)
             result = self.mTask.execIt()
         except Exception:
             logException("Task failed:" + self.mTask.getDescr())
             self.mTask.setStatus("Failed, ask tech support")
-            result = None
+            result, failed = None, True
         self.mTask._setPool(None)
-        pool.setResult(self.mTask, result, self.mOrdNo)
+        rss_end, max_rss_end = _currentRSS(), _maxRSS()
+        if max_rss_end > max_rss_start:
+            rss_end = max(rss_end, max_rss_end)
+        pool._taskDone(self.mTask, max(0, rss_end - rss_start))
+        pool.setResult(self.mTask, pool._storeResult(result), self.mOrdNo,
+            failed)
 
 #===============================================
 class Worker(threading.Thread):
@@ -99,27 +180,130 @@ class Worker(threading.Thread):
             task_h.execIt(self.mMaster)
 
 #===============================================
-class PeriodicalWorker(threading.Thread):
-    def __init__(self, master, name, func, timeout):
-        threading.Thread.__init__(self)
-        self.mMaster = master
+class PeriodicalJob:
+    def __init__(self, name, func, timeout, jitter, overrun_mode):
+        assert overrun_mode in ("skip", "queue")
         self.mName = name
         self.mFunc = func
         self.mTimeout = timeout
+        self.mJitter = jitter
+        self.mOverrunMode = overrun_mode
+        # Jitter shifts each run from its nominal time, it is not
+        # carried into the next period
+        self.mNominalTime = time.monotonic()
+        self.mDueTime = self.mNominalTime
+        self.mActive = False
+        self.mQueued = False
+        self.mRunCount = 0
+        self.mOverrunCount = 0
+        self.mLastDuration = None
+        self.mMaxDuration = 0.
+        self.mTotalDuration = 0.
+
+    def getName(self):
+        return self.mName
+
+    def _scheduleNext(self, now):
+        self.mNominalTime = max(self.mNominalTime + self.mTimeout, now)
+        self.mDueTime = self.mNominalTime
+        if self.mJitter > 0:
+            self.mDueTime += random.uniform(0, self.mJitter)
+
+    def getStat(self):
+        return {
+            "runs": self.mRunCount,
+            "overruns": self.mOverrunCount,
+            "last": self.mLastDuration,
+            "max": self.mMaxDuration,
+            "avg": (self.mTotalDuration / self.mRunCount
+                if self.mRunCount > 0 else None)}
+
+    def execIt(self, pool):
+        tm0 = time.monotonic()
+        try:
+            self.mFunc()
+        except Exception:
+            logException("Periodic work %s failed" % self.mName)
+        duration = time.monotonic() - tm0
+        pool._periodicalJobDone(self, duration)
+
+#===============================================
+class PeriodicalScheduler(threading.Thread):
+    def __init__(self, master, thread_count):
+        threading.Thread.__init__(self, daemon = True)
+        self.mMaster = master
+        # Jobs have their own threads: workers can be busy on long tasks
+        self.mExecutor = ThreadPoolExecutor(thread_count,
+            thread_name_prefix = "periodical")
+        self.mCondition = threading.Condition()
+        self.mJobs = dict()
+        self.mHeap = []
+        self.mSeqNo = 0
+        self.mTerminating = False
         self.start()
 
+    def addJob(self, job):
+        with self.mCondition:
+            assert job.getName() not in self.mJobs
+            self.mJobs[job.getName()] = job
+            self._push(job)
+            self.mCondition.notify()
+
+    def _push(self, job):
+        self.mSeqNo += 1
+        heapq.heappush(self.mHeap, (job.mDueTime, self.mSeqNo, job))
+
+    def jobDone(self, job, duration):
+        with self.mCondition:
+            job.mActive = False
+            job.mRunCount += 1
+            job.mLastDuration = duration
+            job.mMaxDuration = max(job.mMaxDuration, duration)
+            job.mTotalDuration += duration
+            if job.mQueued:
+                job.mQueued = False
+                job.mActive = True
+                self._dispatch(job)
+
+    def getStat(self):
+        with self.mCondition:
+            return {name: job.getStat() for name, job in self.mJobs.items()}
+
+    def terminate(self):
+        with self.mCondition:
+            self.mTerminating = True
+            self.mCondition.notify()
+        self.mExecutor.shutdown(wait = False, cancel_futures = True)
+
+    def _dispatch(self, job):
+        if not self.mTerminating:
+            self.mExecutor.submit(job.execIt, self.mMaster)
+
     def run(self):
-        while True:
-            try:
-                self.mFunc()
-            except Exception:
-                logException("Periodic work %s failed" % self.mName)
-            if self.mMaster._sleep(self.mTimeout):
-                return
+        with self.mCondition:
+            while not self.mTerminating:
+                now = time.monotonic()
+                if len(self.mHeap) == 0 or self.mHeap[0][0] > now:
+                    self.mCondition.wait(self.mHeap[0][0] - now
+                        if len(self.mHeap) > 0 else None)
+                    continue
+                job = heapq.heappop(self.mHeap)[2]
+                if job.mActive:
+                    job.mOverrunCount += 1
+                    if job.mOverrunMode == "queue":
+                        job.mQueued = True
+                else:
+                    job.mActive = True
+                    self._dispatch(job)
+                job._scheduleNext(now)
+                self._push(job)
 
 #===============================================
 class JobPool:
-    def __init__(self, thread_count, pool_size, memory_length):
+    def __init__(self, thread_count, pool_size, memory_length,
+            memory_budget = None, max_bypass = 8,
+            spill_threshold = None, spill_dir = None,
+            periodical_threads = 2):
         self.mThrCondition = threading.Condition()
         self.mLock = threading.Lock()
 
@@ -129,53 +313,170 @@ class JobPool:
         self.mTaskCounts  = defaultdict(int)
         self.mActiveTasks = dict()
         self.mResults    = dict()
+        self.mWaitingTasks = dict()
+        self.mDependents = defaultdict(list)
+        self.mMemBudget = memory_budget
+        self.mMaxBypass = max_bypass
+        self.mRunningMemory = 0
+        self.mRunningCount = 0
+        self.mMemStat = defaultdict(lambda: [0, 0, 0, 0])
+        self.mResultStore = (ResultStore(spill_threshold, spill_dir)
+            if spill_threshold is not None else None)
         self.mTerminating = False
 
+        self.mPeriodicalThreads = periodical_threads
+        self.mScheduler = None
+
         self.mWorkers = [Worker(self)
             for idx in range(int(thread_count))]
-        self.mPeriodicalWorkers = dict()
 
     def getLock(self):
         return self.mLock
 
-    def addPeriodicalWorker(self, name, func, timeout):
+    def addPeriodicalWorker(self, name, func, timeout,
+            jitter = 0, overrun_mode = "skip"):
         with self.mThrCondition:
-            assert name not in self.mPeriodicalWorkers
-            self.mPeriodicalWorkers[name] = PeriodicalWorker(
-                self, name, func, timeout)
+            if self.mScheduler is None:
+                self.mScheduler = PeriodicalScheduler(self,
+                    self.mPeriodicalThreads)
+        self.mScheduler.addJob(
+            PeriodicalJob(name, func, timeout, jitter, overrun_mode))
+
+    def getPeriodicalStat(self):
+        if self.mScheduler is None:
+            return dict()
+        return self.mScheduler.getStat()
+
+    def _periodicalJobDone(self, job, duration):
+        self.mScheduler.jobDone(job, duration)
 
     def close(self):
+        if self.mScheduler is not None:
+            self.mScheduler.terminate()
         with self.mThrCondition:
             self.mTerminating = True
-            self.mThrCondition.notify()
+            self.mThrCondition.notify_all()
         for _ in range(1000):
             with self.mThrCondition:
                 needs_wait = False
-                for w in self.mPeriodicalWorkers.values():
-                    if w.is_alive():
-                        needs_wait = True
-                        break
+                if (self.mScheduler is not None
+                        and self.mScheduler.is_alive()):
+                    needs_wait = True
                 for w in self.mWorkers:
                     if w.is_alive():
                         needs_wait = True
                         break
                 if not needs_wait:
-                    return
+                    break
             time.sleep(.001)
+        # Workers are stopped (or busy on long tasks: then the store
+        # keeps their results in memory)
+        if self.mResultStore is not None:
+            self.mResultStore.close()
 
-    def putTask(self, task, priority = 10):
+    def putTask(self, task, priority = 10, depends_on = None):
         with self.mThrCondition:
-            task_ord_no = self.mTaskCounts[task.getTaskType()]
-            self.mTaskCounts[task.getTaskType()] += 1
-            if len(self.mTaskPool) >= self.mPoolSize:
-                task.setStatus("POOL-OVERFLOW")
-                self.mTaskCounts[task.getTaskType()] += 1
-                self.setResult(task, None, task_ord_no)
-            else:
-                self.mTaskPool.append(TaskHandler(task, task_ord_no, priority))
+            overflow = (len(self.mTaskPool) + len(self.mWaitingTasks)
+                >= self.mPoolSize)
+            if self._registerTask(task, priority, depends_on, overflow):
+                self.mTaskPool.sort(key = TaskHandler.getOrd)
+                self.mThrCondition.notify()
+
+    def putTasks(self, tasks, priority = 10):
+        with self.mThrCondition:
+            overflow = (len(self.mTaskPool) + len(self.mWaitingTasks)
+                + len(tasks) > self.mPoolSize)
+            ready_count = 0
+            for task in tasks:
+                if self._registerTask(task, priority, None, overflow):
+                    ready_count += 1
+            if ready_count > 0:
                 self.mTaskPool.sort(key = TaskHandler.getOrd)
-                self.mActiveTasks[task.getUID()] = task
-            self.mThrCondition.notify()
+                self.mThrCondition.notify(ready_count)
+        return not overflow
+
+    def _registerTask(self, task, priority, depends_on, overflow):
+        task_ord_no = self.mTaskCounts[task.getTaskType()]
+        self.mTaskCounts[task.getTaskType()] += 1
+        if overflow:
+            task.setStatus("POOL-OVERFLOW")
+            self.mTaskCounts[task.getTaskType()] += 1
+            self.setResult(task, None, task_ord_no, True)
+            return False
+        task_h = TaskHandler(task, task_ord_no, priority)
+        self.mActiveTasks[task.getUID()] = task
+        if depends_on:
+            self._setupPrereqs(task_h, depends_on)
+        if task.getUID() not in self.mActiveTasks:
+            return False
+        if len(task_h.mPending) > 0:
+            self.mWaitingTasks[task.getUID()] = task_h
+            return False
+        self.mTaskPool.append(task_h)
+        return True
+
+    def _setupPrereqs(self, task_h, depends_on):
+        task = task_h.getTask()
+        task.mPrereqUIDs = [prereq.getUID()
+            if isinstance(prereq, ExecutionTask) else prereq
+            for prereq in depends_on]
+        failed = False
+        with self.mLock:
+            for prereq_uid in task.mPrereqUIDs:
+                if prereq_uid in self.mActiveTasks:
+                    task_h.mPending.add(prereq_uid)
+                    self.mDependents[prereq_uid].append(task.getUID())
+                elif prereq_uid in self.mResults:
+                    prereq_result = self.mResults[prereq_uid][0]
+                    if self.mResults[prereq_uid][4]:
+                        failed = True
+                    ResultStore.pin(prereq_result)
+                    task._setPrereqResult(prereq_uid, prereq_result)
+                else:
+                    failed = True
+        if failed:
+            self._cancelTaskH(task_h, "Cancelled: prerequisite failed")
+
+    def _cancelTaskH(self, task_h, status):
+        task = task_h.getTask()
+        task.setStatus(status)
+        self.setResult(task, None, task_h.mOrdNo, True)
+
+    def _resolveDependents(self, task_uid, result, failed):
+        to_cancel, ready_count = [], 0
+        for dep_uid in self.mDependents.pop(task_uid, []):
+            task_h = self.mWaitingTasks.get(dep_uid)
+            if task_h is None:
+                continue
+            if failed:
+                del self.mWaitingTasks[dep_uid]
+                to_cancel.append(task_h)
+                continue
+            ResultStore.pin(result)
+            task_h.getTask()._setPrereqResult(task_uid, result)
+            task_h.mPending.discard(task_uid)
+            if len(task_h.mPending) == 0:
+                del self.mWaitingTasks[dep_uid]
+                self.mTaskPool.append(task_h)
+                ready_count += 1
+        if ready_count > 0:
+            self.mTaskPool.sort(key = TaskHandler.getOrd)
+            self.mThrCondition.notify(ready_count)
+        return to_cancel
+
+    def cancelTask(self, task_uid):
+        with self.mThrCondition:
+            task_h = self.mWaitingTasks.pop(task_uid, None)
+            if task_h is None:
+                with self.mLock:
+                    for idx, pool_task_h in enumerate(self.mTaskPool):
+                        if pool_task_h.getTask().getUID() == task_uid:
+                            task_h = self.mTaskPool.pop(idx)
+                            break
+            if task_h is None:
+                return False
+            self._cancelTaskH(task_h, "Cancelled")
+            return True
 
     def _cleanUp(self):
         to_remove = []
@@ -185,16 +486,38 @@ class JobPool:
                     < self.mTaskCounts[task_type] - self.mMemLength):
                 to_remove.append(uid)
         for uid in to_remove:
+            ResultStore.discard(self.mResults[uid][0])
             del self.mResults[uid]
 
-    def setResult(self, task, result, task_ord_no):
-        with self.mLock:
-            if task.getUID() in self.mActiveTasks:
-                del self.mActiveTasks[task.getUID()]
-            if result is not False:
-                self.mResults[task.getUID()] = [result, task.getStatus(),
-                    (task.getTaskType(), task_ord_no)]
-                self._cleanUp()
+    def _storeResult(self, result):
+        if self.mResultStore is None:
+            return result
+        try:
+            return self.mResultStore.store(result)
+        except Exception:
+            logException("Result spill failed")
+        return result
+
+    def setResult(self, task, result, task_ord_no, failed = False):
+        with self.mThrCondition:
+            with self.mLock:
+                if task.getUID() in self.mActiveTasks:
+                    del self.mActiveTasks[task.getUID()]
+                version = task._markDone()
+                # Spilled results of prerequisites are kept until
+                # the task is done
+                for prereq_result in task.mPrereqResults.values():
+                    ResultStore.unpin(prereq_result)
+                task.mPrereqResults = dict()
+                if result is not False:
+                    self.mResults[task.getUID()] = [result, task.getStatus(),
+                        (task.getTaskType(), task_ord_no), version, failed]
+                to_cancel = self._resolveDependents(task.getUID(),
+                    result, failed)
+                if result is not False:
+                    self._cleanUp()
+            for task_h in to_cancel:
+                self._cancelTaskH(task_h, "Cancelled: prerequisite failed")
 
     def _pickTask(self):
         while True:
@@ -202,19 +525,107 @@ class JobPool:
                 if self.mTerminating:
                     return None
                 with self.mLock:
-                    if len(self.mTaskPool) > 0:
-                        return self.mTaskPool.pop()
+                    task_h = self._admitTask()
+                    if task_h is not None:
+                        return task_h
                 self.mThrCondition.wait()
 
-    def _sleep(self, timeout):
+    def _admitTask(self):
+        if len(self.mTaskPool) == 0:
+            return None
+        if self.mMemBudget is None:
+            self.mRunningCount += 1
+            return self.mTaskPool.pop()
+        bypassed = []
+        for idx in range(len(self.mTaskPool) - 1, -1, -1):
+            task_h = self.mTaskPool[idx]
+            mem_estimate = task_h.getTask().getMemEstimate()
+            if (self.mRunningMemory == 0 or self.mRunningMemory
+                    + mem_estimate <= self.mMemBudget):
+                del self.mTaskPool[idx]
+                self.mRunningCount += 1
+                self.mRunningMemory += mem_estimate
+                for bypassed_h in bypassed:
+                    bypassed_h.mBypassCount += 1
+                return task_h
+            if task_h.mBypassCount >= self.mMaxBypass:
+                break
+            bypassed.append(task_h)
+        return None
+
+    def _taskDone(self, task, observed_rss):
         with self.mThrCondition:
-            self.mThrCondition.wait_for(lambda: self.mTerminating, timeout)
-            return self.mTerminating
+            with self.mLock:
+                self.mRunningCount -= 1
+                if self.mMemBudget is not None:
+                    self.mRunningMemory -= task.getMemEstimate()
+                stat = self.mMemStat[task.getTaskType()]
+                stat[0] += 1
+                stat[1] += task.getMemEstimate()
+                stat[2] += observed_rss
+                stat[3] = max(stat[3], observed_rss)
+            if self.mMemBudget is not None:
+                self.mThrCondition.notify_all()
 
-    def askTaskStatus(self, task_uid):
+    def getThreadCount(self):
+        return len(self.mWorkers)
+
+    def getQueueDepth(self):
         with self.mLock:
-            if task_uid in self.mResults:
-                return self.mResults[task_uid][:2]
-            if task_uid in self.mActiveTasks:
-                return [False, self.mActiveTasks[task_uid].getStatus()]
+            return (len(self.mTaskPool) + len(self.mWaitingTasks)
+                + self.mRunningCount)
+
+    def getMemoryStat(self):
+        with self.mLock:
+            return {task_type: {
+                "count": count,
+                "estimated-avg": sum_estimate / count,
+                "observed-avg": sum_observed / count,
+                "observed-max": max_observed}
+                for task_type, (count, sum_estimate,
+                    sum_observed, max_observed) in self.mMemStat.items()}
+
+    def _taskStatus(self, task_uid):
+        if task_uid in self.mResults:
+            return self.mResults[task_uid][:2]
+        if task_uid in self.mActiveTasks:
+            return [False, self.mActiveTasks[task_uid].getStatus()]
         return None
+
+    @staticmethod
+    def _loadResult(info):
+        if info is not None and info[0] is not False:
+            info[0] = ResultStore.load(info[0])
+        return info
+
+    def askTaskStatus(self, task_uid):
+        with self.mLock:
+            info = self._taskStatus(task_uid)
+        return self._loadResult(info)
+
+    def askTaskStatuses(self, task_uids):
+        with self.mLock:
+            ret = {task_uid: self._taskStatus(task_uid)
+                for task_uid in task_uids}
+        for info in ret.values():
+            self._loadResult(info)
+        return ret
+
+    def _taskStatusInfo(self, task_uid):
+        if task_uid in self.mResults:
+            result, status, _, version, _ = self.mResults[task_uid]
+            return [result, status, version], None
+        task = self.mActiveTasks.get(task_uid)
+        if task is None:
+            return None, None
+        return [False, *task.getStatusInfo()], task
+
+    def waitStatusChange(self, task_uid, since_version, timeout):
+        with self.mLock:
+            info, task = self._taskStatusInfo(task_uid)
+        if task is None or info[2] > since_version:
+            return self._loadResult(info)
+        task.waitStatusChange(since_version, timeout)
+        with self.mLock:
+            info = self._taskStatusInfo(task_uid)[0]
+        return self._loadResult(info)
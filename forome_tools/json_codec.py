@@ -0,0 +1,200 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os, json
+#===============================================
+# Facade over JSON libraries: orjson, ujson or simdjson is used if
+# installed, standard json otherwise. Output is the same for all backends:
+# no ASCII escaping, compact separators, or separators ", " and ": "
+# with indentation. Cases where backends differ from standard json go
+# to it: non-finite floats and floats in exponent form, types out of JSON
+# (dates, subclasses, ...), integers out of 64 bits; orjson and ujson
+# are used only for encoding
+#===============================================
+sBackends = ("orjson", "ujson", "simdjson")
+
+class _Codec:
+    sName = "json"
+    sFastLoadsF = None
+    sFastDumpsF = None
+
+def _setupOrjson():
+    import orjson
+
+    def _dumps(obj, sort_keys, indent):
+        if indent is not None and indent != 2:
+            return None
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option = option)
+    # orjson parses integers out of 64 bits as floats, without error
+    return None, _dumps
+
+def _setupUjson():
+    import ujson
+
+    def _dumps(obj, sort_keys, indent):
+        if indent is not None:
+            return None
+        return ujson.dumps(obj, ensure_ascii = False, sort_keys = sort_keys,
+            escape_forward_slashes = False).encode("utf-8")
+    # ujson parses invalid JSON without error: "01", "1.", "-",
+    # raw control characters in strings
+    return None, _dumps
+
+def _setupSimdjson():
+    import simdjson
+    return simdjson.loads, None
+
+def setBackend(name = None):
+    # name is None: for parsing and for encoding the first installed
+    # from sBackends that supports it
+    setup_table = {"orjson": _setupOrjson, "ujson": _setupUjson,
+        "simdjson": _setupSimdjson}
+    _Codec.sName, _Codec.sFastLoadsF, _Codec.sFastDumpsF = "json", None, None
+    if name == "json":
+        return _Codec.sName
+    used = []
+    for backend in ([name] if name else sBackends):
+        assert backend in setup_table, "Unknown JSON backend: " + backend
+        try:
+            loads_f, dumps_f = setup_table[backend]()
+        except ImportError:
+            if name:
+                raise
+            continue
+        if _Codec.sFastLoadsF is None and loads_f is not None:
+            _Codec.sFastLoadsF = loads_f
+            used.append(backend)
+        if _Codec.sFastDumpsF is None and dumps_f is not None:
+            _Codec.sFastDumpsF = dumps_f
+            if backend not in used:
+                used.append(backend)
+    if len(used) > 0:
+        _Codec.sName = "+".join(used)
+    return _Codec.sName
+
+def getBackend():
+    return _Codec.sName
+
+#===============================================
+sPlainScalarTypes = {str, int, bool, type(None)}
+
+def _isPlain(obj):
+    # Python writes floats out of [1e-4, 1e16) in exponent form, backends
+    # write exponent differently; NaN and Infinity are not in JSON
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        obj_type = type(obj)
+        if obj_type is dict:
+            for key, val in obj.items():
+                if type(key) is not str:
+                    return False
+                stack.append(val)
+        elif obj_type is list or obj_type is tuple:
+            stack.extend(obj)
+        elif obj_type is float:
+            if obj != 0. and not 1e-4 <= abs(obj) < 1e16:
+                return False
+        elif obj_type not in sPlainScalarTypes:
+            return False
+    return True
+
+#===============================================
+def loads(rep):
+    if _Codec.sFastLoadsF is not None:
+        try:
+            return _Codec.sFastLoadsF(rep)
+        except (ValueError, RuntimeError):
+            # Standard json is more tolerant (NaN, huge integers),
+            # and it reports errors in the same way for all backends
+            pass
+    return json.loads(rep)
+
+def dumpsBytes(obj, sort_keys = False, indent = None, ensure_ascii = False):
+    if (_Codec.sFastDumpsF is not None and not ensure_ascii
+            and _isPlain(obj)):
+        try:
+            ret = _Codec.sFastDumpsF(obj, sort_keys, indent)
+            if ret is not None:
+                return ret
+        except (TypeError, ValueError, OverflowError):
+            # Not supported by backend: integers out of 64 bits...
+            pass
+    return json.dumps(obj, ensure_ascii = ensure_ascii,
+        sort_keys = sort_keys, indent = indent,
+        separators = (",", ":") if indent is None else (",", ": ")
+        ).encode("utf-8")
+
+def dumps(obj, sort_keys = False, indent = None, ensure_ascii = False):
+    return dumpsBytes(obj, sort_keys, indent, ensure_ascii).decode("utf-8")
+
+setBackend(os.environ.get("FOROME_JSON_BACKEND"))
+
+#===============================================
+if __name__ == "__main__":
+    import sys, random, timeit
+
+    def _makeRecord(idx, rand):
+        return {
+            "_id": "chr%d-%d-A-G" % (1 + idx % 22, 100000 + idx * 37),
+            "_filters": {"Chromosome": "chr%d" % (1 + idx % 22),
+                "Start_Pos": 100000 + idx * 37, "Min_GQ": rand.randint(0, 99),
+                "Symbol": ["BRCA%d" % (idx % 3), "TP53"],
+                "Polyphen_2_HVAR": ["D", "P", "B"][:1 + idx % 3],
+                "gnomAD_AF": rand.random() * 1e-3, "Has_Variant": True},
+            "_view": {"general": {"genes": ["BRCA1"], "hg19": "chr1:%d" % idx,
+                "worst_annotation": "missense_variant", "comment": "Ωμέγα"},
+                "quality_samples": [{"genotype_quality": rand.randint(0, 99),
+                    "allelic_depth": "%d,%d" % (rand.randint(0, 50),
+                    rand.randint(0, 50)), "strand_bias": None,
+                    "score": rand.random()} for _ in range(3)],
+                "predictions": {"sift": [rand.random()
+                    for _ in range(5)], "polyphen": None}}}
+
+    rand = random.Random(179)
+    records = [_makeRecord(idx, rand) for idx in range(2000)]
+    lines = [dumpsBytes(rec) for rec in records]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    def _measure(name):
+        setBackend(name)
+        tm_loads = min(timeit.repeat(lambda: [loads(line)
+            for line in lines], number = 1, repeat = count))
+        tm_dumps = min(timeit.repeat(lambda: [dumpsBytes(rec)
+            for rec in records], number = 1, repeat = count))
+        return tm_loads, tm_dumps
+
+    base_loads, base_dumps = _measure("json")
+    print("%d records, %.1f KB average line" % (len(records),
+        sum(len(line) for line in lines) / len(lines) / 1024))
+    print("%-10s loads: %7.2f ms        dumps: %7.2f ms"
+        % ("json", 1000 * base_loads, 1000 * base_dumps))
+    for name in sBackends:
+        try:
+            tm_loads, tm_dumps = _measure(name)
+        except ImportError:
+            print("%-10s not installed" % name)
+            continue
+        print("%-10s loads: %7.2f ms (x%.1f) dumps: %7.2f ms (x%.1f)" % (name,
+            1000 * tm_loads, base_loads / tm_loads,
+            1000 * tm_dumps, base_dumps / tm_dumps))
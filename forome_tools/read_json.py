@@ -18,50 +18,300 @@
 #  limitations under the License.
 #
 
-import gzip, bz2, json
+import io, gzip, bz2, queue, multiprocessing, traceback
 from glob import glob
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from . import json_codec
+from .gzip_index import GzipIndex
 
 #===============================================
-class PlainFileReader:
-    def __init__(self, fname):
-        self.mInput = open(fname, 'r', encoding = 'utf-8')
+# Input is opened in binary mode: nextLine() reads it through text wrapper,
+# readBatch() switches reader to block mode: large blocks are split into
+# lines of bytes, ready for parser
+class _LineReader:
+    sBlockSize = 1 << 20
+
+    def __init__(self, inp):
+        self.mInput = inp
+        self.mText = None
+        self.mBlockMode = False
+        self.mLines = []
+        self.mLinePos = 0
+        self.mTail = b""
+
+    def _readBlock(self):
+        if self.mText is not None:
+            # Text wrapper has its own buffer, so continue reading from it
+            return self.mText.read(self.sBlockSize).encode("utf-8")
+        return self.mInput.read(self.sBlockSize)
+
+    def _fill(self):
+        block = self._readBlock()
+        if not block:
+            if not self.mTail:
+                return False
+            self.mLines, self.mLinePos, self.mTail = [self.mTail], 0, b""
+            return True
+        lines = block.split(b'\n')
+        lines[0] = self.mTail + lines[0]
+        self.mTail = lines.pop()
+        self.mLines, self.mLinePos = lines, 0
+        return True
 
     def nextLine(self):
-        return self.mInput.readline()
+        if not self.mBlockMode:
+            if self.mText is None:
+                self.mText = io.TextIOWrapper(self.mInput, encoding = "utf-8")
+            return self.mText.readline()
+        while self.mLinePos >= len(self.mLines):
+            if not self._fill():
+                return ""
+        self.mLinePos += 1
+        return self.mLines[self.mLinePos - 1].decode("utf-8") + '\n'
+
+    def readBatch(self, count):
+        # Lines without end-of-line, empty list at end of file
+        self.mBlockMode = True
+        ret = []
+        while len(ret) < count:
+            if self.mLinePos >= len(self.mLines) and not self._fill():
+                break
+            pos = self.mLinePos
+            self.mLinePos = min(len(self.mLines), pos + count - len(ret))
+            ret += self.mLines[pos:self.mLinePos]
+        return ret
 
     def close(self):
-        self.mInput.close()
+        if self.mText is not None:
+            self.mText.close()
+        else:
+            self.mInput.close()
 
 #===============================================
-class GzipFileReader:
+class PlainFileReader(_LineReader):
     def __init__(self, fname):
-        self.mInput = gzip.open(fname, 'rt', encoding = "utf-8")
+        _LineReader.__init__(self, open(fname, 'rb'))
 
-    def nextLine(self):
-        return self.mInput.readline()
-
-    def close(self):
-        self.mInput.close()
+#===============================================
+class GzipFileReader(_LineReader):
+    def __init__(self, fname):
+        _LineReader.__init__(self, gzip.open(fname, 'rb'))
 
 #===============================================
-class Bz2FileReader:
+class Bz2FileReader(_LineReader):
     def __init__(self, fname):
-        self.mInput = bz2.BZ2File.open(fname, 'rt', encoding = "utf-8")
+        _LineReader.__init__(self, bz2.open(fname, 'rb'))
 
-    def nextLine(self):
-        return self.mInput.readline()
+#===============================================
+# Reads .gz file with access point index: when index is absent it is built
+# during the reading and saved next to the file at the end
+class IndexedGzipFileReader(_LineReader):
+    def __init__(self, fname, index = None, start_line = 0, span = None):
+        if index is None:
+            assert start_line == 0, "Index is required to start from line"
+            stream = GzipIndex.makeBuilderStream(fname, span)
+        else:
+            stream = index.openStream(start_line)
+        _LineReader.__init__(self, io.BufferedReader(stream, 1 << 16))
+
+#===============================================
+def _openFileReader(fname, gz_index = False):
+    if fname.endswith('.gz'):
+        if gz_index:
+            return IndexedGzipFileReader(fname, GzipIndex.load(fname))
+        return GzipFileReader(fname)
+    if fname.endswith('.bz2'):
+        return Bz2FileReader(fname)
+    return PlainFileReader(fname)
+
+#===============================================
+def _parseLines(lines, parse_json, transform_f):
+    if not parse_json:
+        return [line.decode("utf-8").rstrip() for line in lines]
+    if transform_f is None:
+        return [json_codec.loads(line) for line in lines]
+    return [transform_f(json_codec.loads(line)) for line in lines]
+
+# Runs in worker process: lines are passed joined, it is cheaper to pickle
+def _parseLineBatch(text, transform_f):
+    return _parseLines(text.split(b'\n'), True, transform_f)
+
+#===============================================
+# Runs in worker process: reads one file, sends batches of records
+# (file_idx, line_no, records), then (file_idx, None, line_count)
+# or (file_idx, None, error_text)
+def _readFileWorker(fname, file_idx, parse_json, transform_f,
+        batch_size, out_queue):
+    try:
+        reader = _openFileReader(fname)
+        line_no = 0
+        while True:
+            lines = reader.readBatch(batch_size)
+            if len(lines) == 0:
+                break
+            out_queue.put((file_idx, line_no,
+                _parseLines(lines, parse_json, transform_f)))
+            line_no += len(lines)
+        reader.close()
+        out_queue.put((file_idx, None, line_no))
+    except Exception:
+        out_queue.put((file_idx, None,
+            "Failed to read %s:\n%s" % (fname, traceback.format_exc())))
+
+#===============================================
+class ConcurrentFileReader:
+    sPollTimeout = 1.
+
+    def __init__(self, sources, parse_json = True, transform_f = None,
+            file_workers = 4, ordered = True, batch_size = 1000,
+            queue_size = 8):
+        self.mSources = sources
+        self.mParseMode = parse_json
+        self.mTransF = transform_f
+        self.mFileWorkers = file_workers
+        self.mOrdered = ordered
+        self.mBatchSize = batch_size
+        self.mQueueSize = queue_size
+        self.mCtx = multiprocessing.get_context()
+        self.mProcesses = dict()
+        self.mQueues = dict()
+        self.mSharedQueue = (None if ordered
+            else self.mCtx.Queue(queue_size * file_workers))
+        self.mNextToStart = 0
+        self.mLineCounts = dict()
+
+    def getSources(self):
+        return self.mSources
+
+    def isOrdered(self):
+        return self.mOrdered
+
+    def getLineCount(self, file_idx):
+        return self.mLineCounts.get(file_idx)
+
+    def _startWorkers(self):
+        running = sum(1 for proc in self.mProcesses.values()
+            if proc.is_alive())
+        while (running < self.mFileWorkers
+                and self.mNextToStart < len(self.mSources)):
+            file_idx = self.mNextToStart
+            self.mNextToStart += 1
+            if self.mOrdered:
+                out_queue = self.mQueues[file_idx] = self.mCtx.Queue(
+                    self.mQueueSize)
+            else:
+                out_queue = self.mSharedQueue
+            proc = self.mCtx.Process(target = _readFileWorker,
+                args = (self.mSources[file_idx], file_idx, self.mParseMode,
+                    self.mTransF, self.mBatchSize, out_queue), daemon = True)
+            proc.start()
+            self.mProcesses[file_idx] = proc
+            running += 1
+
+    def _get(self, in_queue, file_idx = None):
+        while True:
+            try:
+                return in_queue.get(timeout = self.sPollTimeout)
+            except queue.Empty:
+                pass
+            self._startWorkers()
+            check_idxs = ([file_idx] if file_idx is not None
+                else list(self.mProcesses.keys()))
+            for idx in check_idxs:
+                proc = self.mProcesses[idx]
+                # Process finishes only after its data is flushed to queue
+                if not proc.is_alive() and in_queue.empty():
+                    raise RuntimeError("Reader of %s exited with code %s"
+                        % (self.mSources[idx], proc.exitcode))
+
+    def _fileDone(self, file_idx, info):
+        proc = self.mProcesses.pop(file_idx)
+        self.mQueues.pop(file_idx, None)
+        proc.join()
+        if isinstance(info, str):
+            raise RuntimeError(info)
+        self.mLineCounts[file_idx] = info
+
+    def __iter__(self):
+        # Yields (file_idx, line_no_in_file, record)
+        try:
+            if self.mOrdered:
+                for file_idx in range(len(self.mSources)):
+                    self._startWorkers()
+                    while True:
+                        _, line_no, batch = self._get(
+                            self.mQueues[file_idx], file_idx)
+                        if line_no is None:
+                            self._fileDone(file_idx, batch)
+                            break
+                        for idx, rec in enumerate(batch):
+                            yield file_idx, line_no + idx, rec
+                        self._startWorkers()
+            else:
+                self._startWorkers()
+                while len(self.mProcesses) > 0:
+                    file_idx, line_no, batch = self._get(self.mSharedQueue)
+                    if line_no is None:
+                        self._fileDone(file_idx, batch)
+                        self._startWorkers()
+                        continue
+                    for idx, rec in enumerate(batch):
+                        yield file_idx, line_no + idx, rec
+        finally:
+            self.close()
 
     def close(self):
-        self.mInput.close()
+        for proc in self.mProcesses.values():
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        self.mProcesses.clear()
+        self.mQueues.clear()
 
 #===============================================
 class JsonLineReader:
-    def __init__(self, source, parse_json = True,  transform_f = None):
+    def __init__(self, source, parse_json = True,  transform_f = None,
+            workers = 0, batch_size = 2000, max_in_flight = None,
+            file_workers = 0, ordered = True, gz_index = False,
+            start_line = 0, end_line = None):
         self.mSources = sorted(glob(source)) if "*" in source else [source]
         self.mCurReader = None
+        self.mCurSource = None
         self.mParseMode = parse_json
         self.mTransF = transform_f
         self.mCurLineNo = -1
+        # Parallel mode: transform_f should be picklable (module level)
+        self.mWorkers = workers if parse_json else 0
+        self.mBatchSize = batch_size
+        self.mMaxInFlight = (max_in_flight if max_in_flight is not None
+            else 2 * workers)
+        self.mExecutor = None
+        self.mInFlight = deque()
+        self.mBatch = None
+        self.mBatchIdx = 0
+        self.mBatchLineNo = 0
+        self.mBatchSource = None
+        self.mReadLineNo = -1
+        # Concurrent mode: several files are read at once by processes
+        self.mConcReader = None
+        self.mConcIter = None
+        if file_workers > 0 and len(self.mSources) > 1:
+            self.mConcReader = ConcurrentFileReader(self.mSources,
+                parse_json, transform_f, file_workers, ordered)
+            self.mConcIter = iter(self.mConcReader)
+            self.mSources = []
+        self.mConcFileIdx = None
+        self.mConcLineOffset = 0
+        # Resumable reading: lines [start_line, end_line) in numbering
+        # of the sequential mode, .gz files are positioned by index
+        self.mGzIndex = gz_index
+        self.mStartLine = start_line if start_line > 0 else None
+        self.mEndLine = end_line
+        if self.mStartLine is not None or self.mEndLine is not None:
+            assert self.mConcReader is None and self.mWorkers == 0, (
+                "Line range is supported only in sequential mode")
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
@@ -79,17 +329,195 @@ class JsonLineReader:
     def getCurLineNo(self):
         return self.mCurLineNo
 
+    def getCurSource(self):
+        return self.mCurSource
+
     def close(self):
         self.mCurLineNo = -1
         if self.mCurReader is not None:
             self.mCurReader.close()
+            self.mCurReader = None
+        self._stopExecutor()
+        if self.mConcReader is not None:
+            self.mConcIter.close()
+            self.mConcReader = None
+
+    def _stopExecutor(self):
+        if self.mExecutor is not None:
+            for _, _, future in self.mInFlight:
+                future.cancel()
+            self.mInFlight.clear()
+            self.mExecutor.shutdown(wait = True)
+            self.mExecutor = None
 
     def nextLine(self):
         return self.readOne()
 
+    def _readRawBatch(self):
+        # Batch never crosses file boundary: line numbers of the sequential
+        # mode count end of each file as a line
+        while True:
+            if self.mCurReader is None:
+                if len(self.mSources) == 0:
+                    return None
+                self._openNextSource()
+            lines = self.mCurReader.readBatch(self.mBatchSize)
+            if len(lines) == 0:
+                self.mReadLineNo += 1
+                self.mCurReader.close()
+                self.mCurReader = None
+                continue
+            line_no = self.mReadLineNo + 1
+            self.mReadLineNo += len(lines)
+            return line_no, self.mCurSource, b'\n'.join(lines)
+
+    def _readOneParallel(self):
+        while True:
+            if self.mBatch is not None and self.mBatchIdx < len(self.mBatch):
+                self.mCurLineNo = self.mBatchLineNo + self.mBatchIdx
+                self.mCurSource = self.mBatchSource
+                self.mBatchIdx += 1
+                return self.mBatch[self.mBatchIdx - 1]
+            self.mBatch = None
+            if self.mExecutor is None:
+                self.mExecutor = ProcessPoolExecutor(self.mWorkers)
+            while len(self.mInFlight) < self.mMaxInFlight:
+                raw_batch = self._readRawBatch()
+                if raw_batch is None:
+                    break
+                line_no, source, text = raw_batch
+                self.mInFlight.append((line_no, source, self.mExecutor.submit(
+                    _parseLineBatch, text, self.mTransF)))
+            if len(self.mInFlight) == 0:
+                self._stopExecutor()
+                return None
+            self.mBatchLineNo, self.mBatchSource, future = (
+                self.mInFlight.popleft())
+            self.mBatch = future.result()
+            self.mBatchIdx = 0
+
+    def _openNextSource(self):
+        self.mCurSource = self.mSources.pop(0)
+        self.mCurReader = _openFileReader(self.mCurSource, self.mGzIndex)
+
+    def _skipToStart(self):
+        target, self.mStartLine = self.mStartLine, None
+        while self.mCurLineNo + 1 < target:
+            if self.mCurReader is None:
+                if len(self.mSources) == 0:
+                    return
+                source = self.mSources[0]
+                index = (GzipIndex.load(source)
+                    if self.mGzIndex and source.endswith('.gz') else None)
+                if index is None:
+                    self._openNextSource()
+                    continue
+                self.mSources.pop(0)
+                rel_line = target - self.mCurLineNo - 1
+                if rel_line >= index.getLineCount():
+                    self.mCurLineNo += index.getLineCount() + 1
+                    continue
+                self.mCurSource = source
+                self.mCurReader = IndexedGzipFileReader(
+                    source, index, rel_line)
+                self.mCurLineNo += rel_line
+                return
+            lines = self.mCurReader.readBatch(
+                min(target - self.mCurLineNo - 1, 1 << 16))
+            if len(lines) == 0:
+                self.mCurLineNo += 1
+                self.mCurReader.close()
+                self.mCurReader = None
+                continue
+            self.mCurLineNo += len(lines)
+
+    def _stopAtEnd(self):
+        if self.mCurReader is not None:
+            self.mCurReader.close()
+            self.mCurReader = None
+        self.mSources = []
+
+    def _readOneConcurrent(self):
+        try:
+            file_idx, line_no, rec = next(self.mConcIter)
+        except StopIteration:
+            self.mConcReader = None
+            return None
+        sources = self.mConcReader.getSources()
+        self.mCurSource = sources[file_idx]
+        if not self.mConcReader.isOrdered():
+            # Unordered mode: line number in the current file
+            self.mCurLineNo = line_no
+            return rec
+        # Ordered mode: line numbers as in the sequential mode
+        while self.mConcFileIdx != file_idx:
+            if self.mConcFileIdx is None:
+                self.mConcFileIdx = 0
+            else:
+                self.mConcLineOffset += self.mConcReader.getLineCount(
+                    self.mConcFileIdx) + 1
+                self.mConcFileIdx += 1
+        self.mCurLineNo = self.mConcLineOffset + line_no
+        return rec
+
+    def readBatch(self, count):
+        # Up to count records, empty list at the end
+        if self.mConcReader is not None or self.mWorkers > 0:
+            ret = []
+            while len(ret) < count:
+                rec = self.readOne()
+                if rec is None:
+                    break
+                ret.append(rec)
+            return ret
+        if self.mStartLine is not None:
+            self._skipToStart()
+        ret = []
+        # Ends of files are counted as lines, but only before next record
+        cnt_eof = 0
+        while len(ret) < count:
+            if self.mCurReader is None:
+                if len(self.mSources) == 0:
+                    break
+                self._openNextSource()
+            to_read = count - len(ret)
+            if self.mEndLine is not None:
+                to_read = min(to_read,
+                    self.mEndLine - self.mCurLineNo - cnt_eof - 1)
+                if to_read <= 0:
+                    self._stopAtEnd()
+                    break
+            lines = self.mCurReader.readBatch(to_read)
+            if len(lines) == 0:
+                cnt_eof += 1
+                self.mCurReader.close()
+                self.mCurReader = None
+                continue
+            self.mCurLineNo += cnt_eof + len(lines)
+            cnt_eof = 0
+            ret += _parseLines(lines, self.mParseMode, self.mTransF)
+        return ret
+
+    def iterBatches(self, count = 1000):
+        while True:
+            batch = self.readBatch(count)
+            if len(batch) == 0:
+                break
+            yield batch
+
     def readOne(self):
+        if self.mConcReader is not None:
+            return self._readOneConcurrent()
+        if self.mWorkers > 0:
+            return self._readOneParallel()
+        if self.mStartLine is not None:
+            self._skipToStart()
         while True:
             if self.mCurReader is not None:
+                if (self.mEndLine is not None
+                        and self.mCurLineNo + 1 >= self.mEndLine):
+                    self._stopAtEnd()
+                    return None
                 line = self.mCurReader.nextLine()
                 self.mCurLineNo += 1
                 if not line:
@@ -97,42 +525,48 @@ class JsonLineReader:
                     self.mCurReader = None
                     continue
                 if self.mParseMode:
-                    rec = json.loads(line)
+                    rec = json_codec.loads(line)
                     if self.mTransF:
                         rec = self.mTransF(rec)
                     return rec
                 return line.rstrip()
             if len(self.mSources) == 0:
                 return None
-            src = self.mSources.pop(0)
-            if src.endswith('.gz'):
-                self.mCurReader = GzipFileReader(src)
-            elif src.endswith('.bz2'):
-                self.mCurReader = Bz2FileReader(src)
-            else:
-                self.mCurReader = PlainFileReader(src)
+            self._openNextSource()
+
+#===============================================
+# Line ranges of .gz file for parallel workers, each range is read by
+# JsonLineReader(fname, gz_index = True, start_line = .., end_line = ..)
+def splitGzipRanges(fname, count, span = None):
+    return GzipIndex.loadOrBuild(fname, span).splitRanges(count)
 
 #===============================================
-def readJSonRecords(src,  transform_f = None):
+def readJSonRecords(src,  transform_f = None,
+        file_workers = 0, ordered = True, with_source = False):
     if '*' in src:
         names = sorted(glob(src))
     else:
         names = [src]
+    if file_workers > 0 and len(names) > 1:
+        # Files are decompressed and parsed by concurrent processes,
+        # transform_f should be picklable (module level)
+        for file_idx, line_no, rec in ConcurrentFileReader(names,
+                True, transform_f, file_workers, ordered):
+            yield (names[file_idx], line_no, rec) if with_source else rec
+        return
     if transform_f is None:
-        process_f = json.loads
+        process_f = json_codec.loads
     else:
         def process_f(line):
-            return transform_f(json.loads(line))
+            return transform_f(json_codec.loads(line))
     for nm in names:
         if nm.endswith('.gz'):
-            with gzip.open(nm, 'rt', encoding = "utf-8") as inp:
-                for line in inp:
-                    yield process_f(line)
+            inp = gzip.open(nm, 'rt', encoding = "utf-8")
         elif nm.endswith('.bz2'):
-            with bz2.BZ2File(nm, 'rt', encoding = "utf-8") as inp:
-                for line in inp:
-                    yield process_f(line)
+            inp = bz2.open(nm, 'rt', encoding = "utf-8")
         else:
-            with open(nm, 'r', encoding = 'utf-8') as inp:
-                for line in inp:
-                    yield process_f(line)
+            inp = open(nm, 'r', encoding = 'utf-8')
+        with inp:
+            for line_no, line in enumerate(inp):
+                rec = process_f(line)
+                yield (nm, line_no, rec) if with_source else rec
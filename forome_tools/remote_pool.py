@@ -0,0 +1,310 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time, pickle, hmac, hashlib, logging, threading
+from base64 import b64encode, b64decode
+from http.client import HTTPException
+
+from . import json_codec
+from .job_pool import JobPool, ExecutionTask
+from .rest import RestAgent
+#===============================================
+# Payloads are pickled objects, so both sides must share the secret:
+# a worker node never unpickles data without a valid signature
+def _packObj(obj, secret):
+    rep = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return (b64encode(rep).decode("ascii"),
+        hmac.new(secret.encode("utf-8"), rep, hashlib.sha256).hexdigest())
+
+def _verifyPayload(payload, sign, secret):
+    # Explicit check, not assert: it must survive python -O
+    try:
+        rep = b64decode(payload, validate = True)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(sign.encode("utf-8"),
+            hmac.new(secret.encode("utf-8"), rep,
+            hashlib.sha256).hexdigest().encode("ascii")):
+        return None
+    return rep
+
+def _unpackObj(payload, sign, secret):
+    rep = _verifyPayload(payload, sign, secret)
+    if rep is None:
+        raise ValueError("Bad payload signature")
+    return pickle.loads(rep)
+
+#===============================================
+class RemoteWorkerApp:
+    def __init__(self):
+        self.mJobPool = None
+        self.mSecret = None
+        self.mMaxPayload = None
+
+    def setup(self, config, in_container):
+        self.mSecret = config["secret"]
+        assert self.mSecret, "Remote worker requires secret"
+        self.mMaxPayload = config.get("max-payload", 1 << 26)
+        pool_cfg = config.get("job-pool", dict())
+        self.mJobPool = JobPool(
+            pool_cfg.get("threads", 4),
+            pool_cfg.get("pool-size", 100),
+            pool_cfg.get("memory-length", 100),
+            memory_budget = pool_cfg.get("memory-budget"))
+
+    def close(self):
+        self.mJobPool.close()
+
+    def checkFilePath(self, path):
+        return None
+
+    @staticmethod
+    def _badRequest(resp_h, error, msg):
+        return resp_h.makeResponse(mode = "txt", content = msg,
+            error = error)
+
+    def request(self, resp_h, rq_path, query_args, rq_descr):
+        # Arguments come in JSON body
+        args = query_args.get("@request")
+        if not isinstance(args, dict):
+            return self._badRequest(resp_h, 400, "JSON body is expected")
+        try:
+            if rq_path == "/submit":
+                payload, sign = args["task"], args["sign"]
+                if not isinstance(payload, str) or not isinstance(sign, str):
+                    return self._badRequest(resp_h, 400, "Bad task payload")
+                if len(payload) > self.mMaxPayload:
+                    return self._badRequest(resp_h, 413,
+                        "Task payload is too large")
+                priority = int(args.get("priority", 10))
+            elif rq_path == "/status":
+                task_uid = int(args["uid"])
+                since_version = int(args.get("since", -1))
+                timeout = float(args.get("timeout", 0))
+        except KeyError as exc:
+            return self._badRequest(resp_h, 400,
+                "Missing argument: %s" % exc.args[0])
+        except (TypeError, ValueError):
+            return self._badRequest(resp_h, 400, "Bad argument")
+        if rq_path == "/submit":
+            rep = _verifyPayload(payload, sign, self.mSecret)
+            if rep is None:
+                return self._badRequest(resp_h, 403,
+                    "Bad payload signature")
+            task = pickle.loads(rep)
+            if not isinstance(task, ExecutionTask):
+                return self._badRequest(resp_h, 400, "Bad task")
+            rq_descr.append("task=" + task.getDescr())
+            self.mJobPool.putTask(task, priority)
+            ret = {"uid": str(task.getUID())}
+        elif rq_path == "/status":
+            info = self.mJobPool.waitStatusChange(task_uid,
+                since_version, timeout)
+            if info is None:
+                ret = {"lost": True}
+            else:
+                result, status, version = info
+                ret = {"status": status, "version": version,
+                    "done": result is not False}
+                if result is not False:
+                    ret["result"], ret["sign"] = _packObj(
+                        result, self.mSecret)
+        elif rq_path == "/load":
+            ret = {"depth": self.mJobPool.getQueueDepth(),
+                "threads": self.mJobPool.getThreadCount()}
+        else:
+            return resp_h.makeResponse(error = 404)
+        return resp_h.makeResponse(mode = "json",
+            content = json_codec.dumps(ret))
+
+#===============================================
+class RemoteNode:
+    # Node failed on connection is not used during sRetryDelay seconds
+    sRetryDelay = 10.
+
+    def __init__(self, url, secret, timeout = 10.):
+        self.mAgent = RestAgent(url.rstrip('/'), calm_mode = True,
+            timeout = timeout)
+        self.mSecret = secret
+        self.mName = url
+        self.mTimeout = timeout
+        self.mDownTime = None
+        self.mDepth = None
+        self.mThreads = 1
+        self.mLoadTime = None
+
+    def getName(self):
+        return self.mName
+
+    def isUp(self):
+        return (self.mDownTime is None
+            or time.monotonic() - self.mDownTime >= self.sRetryDelay)
+
+    def getLoad(self):
+        if self.mDepth is None:
+            return None
+        return self.mDepth / max(1, self.mThreads)
+
+    def getLoadTime(self):
+        return self.mLoadTime
+
+    def setLoad(self, depth, threads, load_time):
+        self.mDepth, self.mThreads, self.mLoadTime = depth, threads, load_time
+
+    def reserve(self):
+        self.mDepth += 1
+
+    def _call(self, args, add_path, timeout = None):
+        try:
+            ret = self.mAgent.call(args, add_path = add_path,
+                timeout = timeout)
+        except (OSError, HTTPException):
+            self.mDownTime = time.monotonic()
+            raise
+        self.mDownTime = None
+        return ret
+
+    def askLoad(self):
+        ret = self._call(dict(), "/load")
+        return ret["depth"], ret["threads"]
+
+    def submit(self, task, priority):
+        payload, sign = _packObj(task, self.mSecret)
+        ret = self._call({"task": payload, "sign": sign,
+            "priority": priority}, "/submit")
+        return ret["uid"]
+
+    def askStatus(self, task_uid, since_version, timeout):
+        ret = self._call({"uid": task_uid, "since": since_version,
+            "timeout": timeout}, "/status", timeout + self.mTimeout)
+        if ret.get("done"):
+            ret["result"] = _unpackObj(ret["result"],
+                ret["sign"], self.mSecret)
+        return ret
+
+#===============================================
+class RemoteTask(ExecutionTask):
+    def __init__(self, dispatcher, task, priority = 10,
+            poll_timeout = 10):
+        ExecutionTask.__init__(self, task.getDescr())
+        self.mDispatcher = dispatcher
+        self.mTask = task
+        self.mPriority = priority
+        self.mPollTimeout = poll_timeout
+
+    def getTaskType(self):
+        return self.mTask.getTaskType()
+
+    def execIt(self):
+        node, remote_uid = self.mDispatcher.submit(
+            self.mTask, self.mPriority)
+        self.setStatus("Sent to " + node.getName())
+        version = -1
+        while True:
+            info = node.askStatus(remote_uid, version, self.mPollTimeout)
+            assert not info.get("lost"), (
+                "Task lost on node " + node.getName())
+            if info["version"] != version:
+                version = info["version"]
+                self.setStatus(info["status"])
+            if info["done"]:
+                return info["result"]
+
+#===============================================
+class RemoteDispatcher:
+    def __init__(self, urls, secret, timeout = 10., load_ttl = 2.):
+        assert secret, "Remote dispatcher requires secret"
+        self.mNodes = [RemoteNode(url, secret, timeout) for url in urls]
+        self.mLoadTTL = load_ttl
+        self.mLock = threading.Lock()
+        self.mStopEvent = threading.Event()
+        # Loads of nodes are polled in background, so selection of node
+        # does not wait for network
+        self.mPollThread = threading.Thread(target = self._pollLoads,
+            name = "remote-pool-poll", daemon = True)
+        self.mPollThread.start()
+
+    def close(self):
+        self.mStopEvent.set()
+        self.mPollThread.join()
+
+    def wrap(self, task, priority = 10):
+        return RemoteTask(self, task, priority)
+
+    def _pollLoads(self):
+        while not self.mStopEvent.is_set():
+            self.refreshLoads()
+            self.mStopEvent.wait(self.mLoadTTL / 2)
+
+    def refreshLoads(self, stale_only = False):
+        for node in self.mNodes:
+            load_time = node.getLoadTime()
+            if not node.isUp() or (stale_only and load_time is not None
+                    and time.monotonic() - load_time < self.mLoadTTL):
+                continue
+            load_time = time.monotonic()
+            try:
+                depth, threads = node.askLoad()
+            except Exception:
+                logging.warning("Remote node unavailable: "
+                    + node.getName())
+                continue
+            with self.mLock:
+                node.setLoad(depth, threads, load_time)
+
+    def submit(self, task, priority):
+        node = self.selectNode()
+        return node, node.submit(task, priority)
+
+    def selectNode(self):
+        self.refreshLoads(stale_only = True)
+        with self.mLock:
+            best_node, best_load = None, None
+            for node in self.mNodes:
+                load = node.getLoad()
+                if not node.isUp() or load is None:
+                    continue
+                if best_load is None or load < best_load:
+                    best_node, best_load = node, load
+            assert best_node is not None, "No remote nodes available"
+            # The next selection sees the queue depth with this task
+            best_node.reserve()
+        return best_node
+
+#===============================================
+if __name__ == "__main__":
+    import sys
+    from wsgiref.simple_server import make_server, WSGIServer
+    from socketserver import ThreadingMixIn
+    from .hserv import setupHServer, HServHandler
+    from .json_conf import loadJSonConfig
+
+    class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    logging.root.setLevel(logging.INFO)
+    config = loadJSonConfig(sys.argv[1])
+    config.setdefault("dir-files", [])
+    host, port = setupHServer(RemoteWorkerApp(), config, False)
+    httpd = make_server(host, port, HServHandler.request,
+        server_class = _ThreadingWSGIServer)
+    print("Remote worker on %s:%d" % (host, httpd.server_port),
+        file = sys.stderr, flush = True)
+    httpd.serve_forever()
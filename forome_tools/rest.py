@@ -18,9 +18,10 @@
 #  limitations under the License.
 #
 
-import json, logging
+import logging
 from urllib.parse import urlsplit, quote
 from http.client import HTTPConnection, HTTPSConnection
+from . import json_codec
 from .bson_adapter import BsonAdapter
 #==================================
 class RestAgent:
@@ -34,7 +35,7 @@ class RestAgent:
     }
 
     def __init__(self, url, name = None, header_type = "json",
-            calm_mode = False):
+            calm_mode = False, accept_bson = False, timeout = None):
         url_info = urlsplit(url)
         self.mScheme = url_info.scheme
         assert url_info.scheme in ("http", "https")
@@ -43,10 +44,16 @@ class RestAgent:
         self.mPath = url_info.path
         self.mHeaderType = header_type
         self.mHeaders = self.sHeadersTab[header_type]
+        if accept_bson:
+            self.mHeaders = dict(self.mHeaders)
+            self.mHeaders["Accept"] = (
+                "application/bson, application/json;q=0.9")
         if self.mPort is None:
             self.mPort = 80
         self.mName = name if name else url
         self.mCalmMode = calm_mode
+        # Timeout of connection and of each socket read, in seconds
+        self.mTimeout = timeout
 
     def _reportCall(self, method, res):
         logging.info("REST " + method  + " call: " + self.mName + " "
@@ -54,23 +61,27 @@ class RestAgent:
 
     def call(self, request_data, method = "POST",
             add_path = "", json_rq_mode = True, calm_mode = False,
-            plain_return = False):
+            plain_return = False, timeout = None):
         if request_data is not None:
             if self.mHeaderType == "www":
                 assert isinstance(request_data, dict)
                 content = "&".join("%s=%s" % (key, quote(str(val)))
                     for key, val in request_data.items())
             elif json_rq_mode:
-                content = json.dumps(request_data, ensure_ascii = False)
+                content = json_codec.dumps(request_data)
             else:
                 content = request_data
         else:
             content = ""
 
+        conn_args = dict()
+        if timeout is not None or self.mTimeout is not None:
+            conn_args["timeout"] = (timeout if timeout is not None
+                else self.mTimeout)
         if self.mScheme == "http":
-            conn = HTTPConnection(self.mHost, self.mPort)
+            conn = HTTPConnection(self.mHost, self.mPort, **conn_args)
         else:
-            conn = HTTPSConnection(self.mHost, self.mPort)
+            conn = HTTPSConnection(self.mHost, self.mPort, **conn_args)
 
         rq_path = self.mPath + add_path
         conn.request(method, rq_path,
@@ -95,4 +106,4 @@ class RestAgent:
             return None
         if bson_mode:
             return BsonAdapter.decode(content)
-        return json.loads(str(content, 'utf-8'))
+        return json_codec.loads(content)
@@ -0,0 +1,171 @@
+#  Copyright (c) 2019. Partners HealthCare and other members of
+#  Forome Association
+#
+#  Developed by Sergey Trifonov based on contributions by Joel Krier,
+#  Michael Bouzinier, Shamil Sunyaev and other members of Division of
+#  Genetics, Brigham and Women's Hospital
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os, sys, pickle, gzip, tempfile, shutil, threading, logging
+from itertools import islice
+
+from .ixbz2 import IndexBZ2, FormatterIndexBZ2
+from .log_err import logException
+#===============================================
+class SpilledResult:
+    def __init__(self, fname, line_mode, size):
+        self.mFName = fname
+        self.mLineMode = line_mode
+        self.mSize = size
+        self.mPinCount = 0
+        self.mDropped = False
+
+    def getSize(self):
+        return self.mSize
+
+    def load(self):
+        try:
+            if self.mLineMode:
+                with IndexBZ2(self.mFName) as index:
+                    return list(index)
+            with gzip.open(self.mFName, "rb") as inp:
+                return pickle.load(inp)
+        except FileNotFoundError:
+            logging.warning("Spilled result is already dropped: "
+                + self.mFName)
+        return None
+
+    # Pins are set by tasks waiting for this result, under pool lock:
+    # the file is removed when it is discarded and not pinned
+    def pin(self):
+        self.mPinCount += 1
+
+    def unpin(self):
+        self.mPinCount -= 1
+        if self.mPinCount == 0 and self.mDropped:
+            self._remove()
+
+    def discard(self):
+        self.mDropped = True
+        if self.mPinCount == 0:
+            self._remove()
+
+    def _remove(self):
+        try:
+            os.remove(self.mFName)
+        except FileNotFoundError:
+            pass
+
+#===============================================
+class ResultStore:
+    sSampleSize = 16
+    sMaxDepth = 4
+
+    def __init__(self, spill_threshold, spill_dir = None):
+        self.mSpillThreshold = spill_threshold
+        self.mDir = tempfile.mkdtemp(prefix = "job-results-", dir = spill_dir)
+        self.mLock = threading.Lock()
+        self.mCount = 0
+        self.mClosed = False
+
+    def _nextFName(self, ext):
+        with self.mLock:
+            self.mCount += 1
+            return os.path.join(self.mDir, "%d.%s" % (self.mCount, ext))
+
+    @staticmethod
+    def _isLineList(result):
+        return (isinstance(result, list) and len(result) > 0
+            and all(isinstance(line, str) and '\n' not in line
+                for line in result))
+
+    @classmethod
+    def _estimateSize(cls, obj, depth = 0):
+        # Memory size of object, items of containers are sampled
+        size = sys.getsizeof(obj)
+        if depth >= cls.sMaxDepth:
+            return size
+        if isinstance(obj, dict):
+            sample = list(islice(obj.items(), cls.sSampleSize))
+            sample_size = sum(cls._estimateSize(key, depth + 1)
+                + cls._estimateSize(val, depth + 1) for key, val in sample)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            sample = list(islice(obj, cls.sSampleSize))
+            sample_size = sum(cls._estimateSize(item, depth + 1)
+                for item in sample)
+        else:
+            return size
+        if len(sample) == 0:
+            return size
+        return size + sample_size * len(obj) // len(sample)
+
+    def store(self, result):
+        if result is None or result is False or self.mClosed:
+            return result
+        try:
+            return self._spill(result)
+        except OSError:
+            # Store can be closed while pool shuts down
+            logException("Result is not spilled", error_mode = False)
+        return result
+
+    def _spill(self, result):
+        if self._isLineList(result):
+            size = sum(len(line) + 1 for line in result)
+            if size < self.mSpillThreshold:
+                return result
+            fname = self._nextFName("ixbz2")
+            with FormatterIndexBZ2(fname, block_size = 2**19) as outp:
+                for line in result:
+                    outp.putLine(line)
+            return SpilledResult(fname, True, size)
+        if isinstance(result, (str, bytes)):
+            if len(result) < self.mSpillThreshold:
+                return result
+        elif self._estimateSize(result) < self.mSpillThreshold:
+            return result
+        # Pickled size is the exact one
+        rep = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        if len(rep) < self.mSpillThreshold:
+            return result
+        fname = self._nextFName("pickle.gz")
+        with gzip.open(fname, "wb", compresslevel = 6) as outp:
+            outp.write(rep)
+        return SpilledResult(fname, False, len(rep))
+
+    @staticmethod
+    def load(result_ref):
+        if isinstance(result_ref, SpilledResult):
+            return result_ref.load()
+        return result_ref
+
+    @staticmethod
+    def discard(result_ref):
+        if isinstance(result_ref, SpilledResult):
+            result_ref.discard()
+
+    @staticmethod
+    def pin(result_ref):
+        if isinstance(result_ref, SpilledResult):
+            result_ref.pin()
+
+    @staticmethod
+    def unpin(result_ref):
+        if isinstance(result_ref, SpilledResult):
+            result_ref.unpin()
+
+    def close(self):
+        self.mClosed = True
+        shutil.rmtree(self.mDir, ignore_errors = True)
@@ -14,6 +14,7 @@ setuptools.setup(
     long_description_content_type = "text/markdown",
     url = "https://github.com/ForomePlatform/forome_misc_tool",
     packages = setuptools.find_packages(),
+    python_requires = ">=3.9",
     classifiers = [
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: Apache Software License",
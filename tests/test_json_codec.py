@@ -0,0 +1,76 @@
+import json, datetime, enum
+import pytest
+
+from forome_tools import json_codec
+
+#===============================================
+class _Level(enum.IntEnum):
+    LOW = 1
+
+sDumpCases = [
+    {"a": 1, "b": [1, 2.5, None, True], "c": "Ωμέγα", "d": {"x": "/"}},
+    float("nan"), float("inf"), -float("inf"), [1.0, float("nan")],
+    1e-7, 1e16, 1.5e300, 5e-324, 0.1, -0.0, 123456.789,
+    2 ** 63 - 1, 2 ** 70, -2 ** 70, [2 ** 64],
+    {1: "int key", 2.5: "b"}, {None: 1}, (1, 2), _Level.LOW,
+    {"z": 1, "a": {"y": 2, "b": 3}}]
+
+sBadDumpCases = [datetime.date(2020, 1, 1), {1, 2}, b"bytes", object()]
+
+sLoadCases = ["123456789012345678901", "[-99999999999999999999]",
+    '{"id": 12345678901234567890}', "NaN", "[Infinity, -Infinity]", "1e400",
+    "0.12345678901234567890123", "1e-7", "[1.0, -0.0]",
+    '"\\u03a9\\ud83d\\ude00"', '"\\ud800"', '{"a": [1, {"b": null}]}',
+    '{"a": 1, "a": 2}', "-0", "[-0.0, 0e0, 1E+2]"]
+
+sBadLoadCases = ["", "[1,", "{'a': 1}", "nul", "-", "01", "-01", "00",
+    "1.", "1.e5", ".5", "+1", "[01]", '{"a": 01}', '"a\x01b"', '"a\nb"',
+    '"\t"', "[1,]", "1 2"]
+
+def _backends():
+    ret = ["json", None]
+    for name in json_codec.sBackends:
+        try:
+            json_codec.setBackend(name)
+            ret.append(name)
+        except ImportError:
+            pass
+    json_codec.setBackend()
+    return ret
+
+@pytest.fixture(params = _backends())
+def backend(request):
+    json_codec.setBackend(request.param)
+    yield request.param
+    json_codec.setBackend()
+
+#===============================================
+@pytest.mark.parametrize("obj", sDumpCases)
+def test_dumps_as_json(backend, obj):
+    for sort_keys in (False, True):
+        assert (json_codec.dumps(obj, sort_keys = sort_keys)
+            == json.dumps(obj, ensure_ascii = False, sort_keys = sort_keys,
+                separators = (",", ":")))
+        for indent in (2, 4):
+            assert (json_codec.dumps(obj, sort_keys, indent)
+                == json.dumps(obj, ensure_ascii = False, sort_keys = sort_keys,
+                    indent = indent, separators = (",", ": ")))
+    assert (json_codec.dumps(obj, ensure_ascii = True)
+        == json.dumps(obj, separators = (",", ":")))
+    assert json_codec.dumpsBytes(obj) == json_codec.dumps(obj).encode("utf-8")
+
+@pytest.mark.parametrize("obj", sBadDumpCases)
+def test_dumps_errors(backend, obj):
+    with pytest.raises(TypeError):
+        json_codec.dumps(obj)
+
+@pytest.mark.parametrize("rep", sLoadCases)
+def test_loads_as_json(backend, rep):
+    expected = repr(json.loads(rep))
+    assert repr(json_codec.loads(rep)) == expected
+    assert repr(json_codec.loads(rep.encode("utf-8"))) == expected
+
+@pytest.mark.parametrize("rep", sBadLoadCases)
+def test_loads_errors(backend, rep):
+    with pytest.raises(ValueError):
+        json_codec.loads(rep)
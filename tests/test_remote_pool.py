@@ -0,0 +1,124 @@
+import os, sys, json, time, subprocess, threading
+import pytest
+
+from forome_tools.job_pool import JobPool, ExecutionTask
+from forome_tools.remote_pool import RemoteDispatcher, _packObj
+from forome_tools.rest import RestAgent
+
+sSecret = "test-secret"
+
+#===============================================
+class SquareTask(ExecutionTask):
+    def __init__(self, value):
+        ExecutionTask.__init__(self, "square %d" % value)
+        self.mValue = value
+
+    def getTaskType(self):
+        return "square"
+
+    def execIt(self):
+        self.setStatus("Computing")
+        time.sleep(.3)
+        return {"square": self.mValue ** 2, "pid": os.getpid()}
+
+def _startWorker(tmp_path, name, optimize = False):
+    config_path = tmp_path / (name + ".cfg")
+    config_path.write_text(json.dumps({"host": "127.0.0.1", "port": 0,
+        "secret": sSecret, "max-payload": 1 << 20,
+        "job-pool": {"threads": 2}}))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        os.path.dirname(os.path.abspath(__file__))])
+    # Signature check must not depend on asserts
+    proc = subprocess.Popen([sys.executable]
+        + (["-O"] if optimize else [])
+        + ["-m", "forome_tools.remote_pool", str(config_path)],
+        env = env, stderr = subprocess.PIPE, text = True)
+    for line in proc.stderr:
+        if line.startswith("Remote worker on "):
+            # Worker logs to stderr, pipe should not get full
+            threading.Thread(target = proc.stderr.read, daemon = True).start()
+            return proc, "http://" + line.split()[-1]
+    proc.kill()
+    pytest.fail("Worker %s did not start" % name)
+
+@pytest.fixture(scope = "module")
+def workers(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("remote_pool")
+    ret = [_startWorker(tmp_path, "w%d" % idx, optimize = idx > 0)
+        for idx in range(2)]
+    yield ret
+    for proc, _ in ret:
+        proc.kill()
+        proc.wait()
+
+def _waitResult(pool, task, timeout = 20.):
+    time_end = time.monotonic() + timeout
+    while time.monotonic() < time_end:
+        result, status = pool.askTaskStatus(task.getUID())
+        if result is not False:
+            return result, status
+        time.sleep(.05)
+    pytest.fail("Task is not done: " + task.getDescr())
+
+#===============================================
+def test_dispatch(workers):
+    dispatcher = RemoteDispatcher([url for _, url in workers], sSecret)
+    pool = JobPool(6, 100, 100)
+    try:
+        tasks = [dispatcher.wrap(SquareTask(value)) for value in range(6)]
+        pool.putTasks(tasks)
+        results = [_waitResult(pool, task)[0] for task in tasks]
+    finally:
+        pool.close()
+        dispatcher.close()
+    assert [res["square"] for res in results] == [
+        value ** 2 for value in range(6)]
+    assert {res["pid"] for res in results} == {
+        proc.pid for proc, _ in workers}
+
+def test_status(workers):
+    dispatcher = RemoteDispatcher([workers[0][1]], sSecret)
+    node = dispatcher.selectNode()
+    remote_uid = node.submit(SquareTask(7), 10)
+    info = node.askStatus(remote_uid, -1, 0)
+    assert not info["done"] and info["version"] >= 0
+    while not info["done"]:
+        info = node.askStatus(remote_uid, info["version"], 5)
+    assert info["result"]["square"] == 49
+    assert node.askStatus("1", -1, 0) == {"lost": True}
+    dispatcher.close()
+
+def test_dead_node(workers):
+    dispatcher = RemoteDispatcher(["http://127.0.0.1:9", workers[0][1]],
+        sSecret, timeout = 2.)
+    for _ in range(3):
+        assert dispatcher.selectNode().getName() == workers[0][1]
+    assert not dispatcher.mNodes[0].isUp()
+    dispatcher.close()
+
+@pytest.mark.parametrize("worker_idx", [0, 1])
+def test_rejections(workers, worker_idx):
+    agent = RestAgent(workers[worker_idx][1], calm_mode = True,
+        timeout = 5.)
+    payload, sign = _packObj(SquareTask(2), sSecret)
+    bad_sign = _packObj(SquareTask(2), "other-secret")[1]
+    for args, status in [
+            ({"task": payload, "sign": bad_sign}, 403),
+            ({"task": payload, "sign": "\u043f"}, 403),
+            ({"task": "not base64!", "sign": sign}, 403),
+            ({"task": payload}, 400),
+            ({"task": 5, "sign": sign}, 400),
+            ({"task": "A" * (2 << 20), "sign": sign}, 413)]:
+        with pytest.raises(RuntimeError, match = r"\(%d\)" % status) as err:
+            agent.call(args, add_path = "/submit")
+        assert "Traceback" not in str(err.value)
+    with pytest.raises(RuntimeError, match = r"\(400\)"):
+        agent.call({"uid": "x"}, add_path = "/status")
+    bad_payload, bad_sign = _packObj({"not": "task"}, sSecret)
+    with pytest.raises(RuntimeError, match = r"\(400\)"):
+        agent.call({"task": bad_payload, "sign": bad_sign},
+            add_path = "/submit")
+    assert "uid" in agent.call({"task": payload, "sign": sign},
+        add_path = "/submit")